@@ -13,41 +13,168 @@
 # under the License.
 from collections import deque
 from datetime import timedelta
+from itertools import count
+import json
+import zlib
 
-from twisted.internet.defer import Deferred, DeferredLock, fail
+from twisted.internet.defer import (CancelledError, Deferred, fail,
+                                    gatherResults)
 from twisted.internet.protocol import DatagramProtocol
 from twisted.python import log
 
-from pyrite.errors import FileNotFound
+from pyrite.errors import FileNotFound, TimedOut, TruncatedReply
+from pyrite.metrics import metrics
+
+
+class TokenBucket(object):
+    """
+    A bucket which fills with tokens at a steady rate, up to a capacity.
+
+    Spending a token is permission to send one packet.
+    """
+
+    # Slop for floating-point error when waking up exactly on time.
+    epsilon = 1e-9
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        elapsed = max(0, now - self.stamp)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """
+        How long until a token is available.
+        """
+
+        self.refill(now)
+        if self.tokens >= 1 - self.epsilon:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
 
 
 class Trickling(object):
+    """
+    A transport wrapper which sends packets no faster than AniDB allows.
+
+    AniDB permits a short burst, then one packet every two seconds, and no
+    more than one packet every four seconds over a longer period. Each limit
+    is modeled as a token bucket, and a packet goes out only when both have
+    a token to spare. After a timeout or a ban, backoff() additionally
+    spaces packets out by an exponentially growing penalty, until relax()
+    is called.
+
+    The total time packets spent queued is kept in waited.
+    """
+
+    _call = None
 
-    def __init__(self, reactor, transport):
+    def __init__(self, reactor, transport, short_rate=0.5, short_burst=5,
+                 long_rate=0.25, long_burst=60, min_penalty=4,
+                 max_penalty=30 * 60):
         self.reactor = reactor
         self.transport = transport
 
-        self.timestamp = reactor.seconds()
+        now = reactor.seconds()
+        self.short = TokenBucket(short_rate, short_burst, now)
+        self.long = TokenBucket(long_rate, long_burst, now)
+
+        self.min_penalty = min_penalty
+        self.max_penalty = max_penalty
+        self.penalty = 0
+
+        self.timestamp = None
+        self.waited = 0
+        self.sent = 0
+
+        self._queue = deque()
+
+    def delay(self, now):
+        """
+        How long until the next packet may be sent.
+        """
+
+        delay = max(self.short.delay(now), self.long.delay(now))
+
+        if self.penalty and self.timestamp is not None:
+            delay = max(delay, self.timestamp + self.penalty - now)
+
+        return delay
 
     def write(self, packet):
-        log.msg("> %r" % packet)
+        """
+        Queue a packet to be sent as soon as it's safe.
+
+        Returns a Deferred which fires with the number of seconds the packet
+        waited, once it has been sent. Cancelling the Deferred before then
+        keeps the packet from being sent.
+        """
+
+        d = Deferred()
+        self._queue.append((packet, d, self.reactor.seconds()))
+        self._pump()
+        return d
+
+    def _wake(self):
+        self._call = None
+        self._pump()
+
+    def _pump(self):
+        if self._call is not None:
+            return
+
+        while self._queue:
+            now = self.reactor.seconds()
+            delay = self.delay(now)
 
-        current = self.reactor.seconds()
-        diff = current - self.timestamp
+            if delay > 0:
+                self._call = self.reactor.callLater(delay, self._wake)
+                return
 
-        if diff >= 4:
-            # We're good to send right now.
+            packet, d, queued = self._queue.popleft()
+            if d.called:
+                # Cancelled while it was waiting.
+                continue
+
+            self.short.take(now)
+            self.long.take(now)
+            self.timestamp = now
+
+            waited = now - queued
+            self.waited += waited
+            self.sent += 1
+            metrics.observe("anidb_queue_wait_seconds", waited)
+            metrics.count("anidb_packets_sent")
+
+            log.msg("> %r" % packet)
             self.transport.write(packet)
-            self.timestamp = current
-        else:
-            # We'll send in the future, when it's safe.
-            target = 4 - diff
-            self.reactor.callLater(target, self.transport.write, packet)
-            self.timestamp = current + target
+            d.callback(waited)
+
+    def backoff(self):
+        """
+        Slow down, because the server is unhappy with us.
+        """
+
+        self.penalty = min(max(self.penalty * 2, self.min_penalty),
+                           self.max_penalty)
+        log.msg("Backing off; %ds between packets" % self.penalty)
 
-        retry = self.reactor.callLater(self.timestamp + 10, self.write,
-                                       packet)
-        return retry
+    def relax(self):
+        """
+        Go back to the normal rate, because the server is happy again.
+        """
+
+        self.penalty = 0
 
 
 def pack(d):
@@ -68,6 +195,46 @@ def request(s, d=None):
     return s
 
 
+def untag(packet):
+    """
+    Split the tag off the front of a reply.
+
+    Replies to untagged requests get a tag of None.
+    """
+
+    first, rest = packet.split(" ", 1)
+    if first.isdigit():
+        return None, packet
+    return first, rest
+
+
+# The longest reply AniDB will send; anything longer is cut off at this many
+# bytes.
+MAX_REPLY = 1400
+
+
+def inflate(data):
+    """
+    Inflate a compressed reply, with its two leading NULs already removed.
+
+    Returns the reply, and whether all of it was there.
+    """
+
+    # Compressed replies are deflated with a zlib header, which always
+    # begins with 0x78 for the window size that AniDB uses; tolerate raw
+    # deflate too.
+    if data[:1] == "\x78":
+        wbits = zlib.MAX_WBITS
+    else:
+        wbits = -zlib.MAX_WBITS
+
+    try:
+        return zlib.decompress(data, wbits), True
+    except zlib.error:
+        # Cut short; salvage what there is.
+        return zlib.decompressobj(wbits).decompress(data), False
+
+
 def postprocess(packet):
     code, data = packet.split(" ", 1)
     code = int(code)
@@ -82,68 +249,253 @@ def standard_errors(t):
         # BANNED
         s = "Banned (API server is butthurt; wait an hour)"
         raise Exception(s)
+    elif code == 501 or code == 506:
+        # LOGIN FIRST, INVALID SESSION
+        raise SessionExpired()
 
     return code, data
 
+
+class SessionExpired(Exception):
+    """
+    The server has forgotten our session.
+    """
+
+
+def load_session(path, now, lifetime=30 * 60):
+    """
+    Load a saved session, if there is one and it is still young enough to
+    be trusted.
+
+    AniDB forgets sessions after 35 minutes without traffic, so by default
+    sessions idle for 30 minutes are not reused.
+    """
+
+    try:
+        with open(path, "rb") as handle:
+            saved = json.load(handle)
+    except (IOError, ValueError):
+        return None
+
+    if now - saved["stamp"] >= lifetime:
+        return None
+
+    return saved
+
+
+def save_session(path, session, port, stamp):
+    """
+    Save a session, and the local port it is bound to, for the next run.
+    """
+
+    with open(path, "wb") as handle:
+        json.dump({
+            "session": session,
+            "port": port,
+            "stamp": stamp,
+        }, handle)
+
+class Pending(object):
+    """
+    An outstanding request, awaiting its reply.
+    """
+
+    timer = None
+    sending = None
+    sent = None
+
+    def __init__(self, packet, canceller=None):
+        self.packet = packet
+        self.attempts = 0
+        self.d = Deferred(canceller)
+
+
 class AniDBProtocol(DatagramProtocol):
     """
     A protocol for communicating with AniDB.
+
+    Every request carries a unique tag, which AniDB echoes at the start of
+    its reply, so replies are matched to requests regardless of the order in
+    which they arrive. Replies for requests which are no longer outstanding
+    are dropped.
     """
 
-    retry = None
+    nat = None
     session = None
     timestamp = 0
 
-    def __init__(self, reactor, address):
+    # Seconds to wait for a reply before sending the request again.
+    timeout = 10
+    # Number of times to send a request before giving up on it.
+    attempts = 4
+
+    def __init__(self, reactor, address, port=9000, limits=None):
         self.reactor = reactor
         self.address = address
+        self.server_port = port
+        self.limits = limits or {}
+
+        self._pending = {}
+        self._tags = count(1)
 
-        self._ds = deque()
-        self._lock = DeferredLock()
+        # When we last asked the server for anything.
+        self.active = reactor.seconds()
 
     def startProtocol(self):
-        self.transport.connect(self.address, 9000)
-        self.transport = Trickling(self.reactor, self.transport)
+        self.transport.connect(self.address, self.server_port)
+        self.transport = Trickling(self.reactor, self.transport,
+                                   **self.limits)
+
+    def keepalive(self, idle=5 * 60):
+        """
+        Poke the server if nothing has been sent for a while, so that
+        neither the session nor any NAT mapping in between expires.
+        """
+
+        if self.session and self.reactor.seconds() - self.active >= idle:
+            d = self.uptime()
+            d.addErrback(log.err, "Keepalive failed")
+
+    def report(self):
+        """
+        Log how long requests spent waiting on the rate limiter.
+        """
+
+        log.msg("Sent %d packets; waited %.1fs on the rate limiter"
+                % (self.transport.sent, self.transport.waited))
 
     def datagramReceived(self, packet, remote):
+        metrics.count("anidb_received_bytes", len(packet))
+
+        if packet.startswith("\x00\x00"):
+            metrics.count("anidb_compressed_replies")
+            try:
+                packet, complete = inflate(packet[2:])
+            except zlib.error as e:
+                self._drop(packet, "corrupt (%s)" % e)
+                return
+        else:
+            complete = len(packet) < MAX_REPLY
+
         log.msg("< %r" % packet)
 
-        if self.retry:
-            self.retry.cancel()
-            self.retry = None
+        try:
+            tag, rest = untag(packet)
+        except ValueError:
+            # Not even the tag is there; whichever request this answered
+            # will be retransmitted.
+            self._drop(packet, "unreadable")
+            return
+
+        try:
+            code, data = postprocess(rest)
+        except ValueError:
+            if complete:
+                self._drop(packet, "unreadable")
+                return
+            # Cut short before the code; still a truncated reply.
+            code, data = None, ""
+
+        metrics.count("anidb_replies")
+
+        if code == 555:
+            metrics.count("anidb_bans")
+            self.transport.backoff()
+        else:
+            self.transport.relax()
 
-        d = self._ds.popleft()
-        d.callback(postprocess(packet))
+        pending = self._pending.get(tag)
+        if pending is None:
+            log.msg("Dropping stale or duplicate reply %r" % packet)
+            metrics.count("anidb_stale_replies")
+            return
 
-        # Lock--
-        self._lock.release()
+        if pending.sent is not None:
+            # Measured from the latest send, which may be a retransmit.
+            metrics.observe("anidb_rtt_seconds",
+                            self.reactor.seconds() - pending.sent)
 
-    def ds(self):
-        d = Deferred()
-        d.addCallback(standard_errors)
+        # Stop any retransmits, including any still queued.
+        self._cancel(tag)
 
-        self._ds.append(d)
+        if not complete:
+            log.msg("Reply to %r was cut short" % pending.packet)
+            metrics.count("anidb_truncated_replies")
+            pending.d.errback(TruncatedReply(code, data))
+            return
 
-        return d
+        pending.d.callback((code, data))
 
-    def write(self, packet):
+    def _drop(self, packet, why):
+        log.msg("Dropping %s reply %r" % (why, packet))
+        metrics.count("anidb_dropped_replies")
+
+    def call(self, command, data=None):
+        """
+        Send a request, eventually.
+
+        Returns a Deferred which fires with the reply's code and data.
+        """
+
+        tag = "T%d" % next(self._tags)
+        self.active = self.reactor.seconds()
+
+        data = dict(data or {})
+        data["tag"] = tag
+
+        pending = Pending(request(command, data),
+                          lambda d: self._cancel(tag))
+        pending.d.addCallback(standard_errors)
+        self._pending[tag] = pending
+
+        self._send(tag)
+
+        return pending.d
+
+    def _cancel(self, tag):
         """
-        Write a packet of data, eventually.
+        Forget about a request, without waiting for its reply.
         """
 
-        # Lock++
-        d = self._lock.acquire()
+        pending = self._pending.pop(tag, None)
+        if pending is None:
+            return
+
+        if pending.timer is not None and pending.timer.active():
+            pending.timer.cancel()
+        if pending.sending is not None and not pending.sending.called:
+            pending.sending.cancel()
+
+    def _send(self, tag):
+        pending = self._pending[tag]
+        pending.attempts += 1
+        pending.sending = d = self.transport.write(pending.packet)
+
         @d.addCallback
-        def cb(lock):
-            self.retry = self.transport.write(packet)
+        def sent(waited):
+            pending.sent = self.reactor.seconds()
+            pending.timer = self.reactor.callLater(self.timeout,
+                                                   self._timedOut, tag)
 
-        return d
+        d.addErrback(lambda f: f.trap(CancelledError))
 
-    def ping(self):
-        payload = request("PING")
-        self.write(payload)
+    def _timedOut(self, tag):
+        pending = self._pending[tag]
+        self.transport.backoff()
+
+        if pending.attempts >= self.attempts:
+            log.msg("Giving up on %r" % pending.packet)
+            metrics.count("anidb_timeouts")
+            del self._pending[tag]
+            pending.d.errback(TimedOut())
+            return
 
-        return self.ds()
+        log.msg("Timed out; retrying %r" % pending.packet)
+        metrics.count("anidb_retransmits")
+        self._send(tag)
+
+    def ping(self):
+        return self.call("PING")
 
     def login(self, username, password):
         data = {
@@ -152,12 +504,16 @@ class AniDBProtocol(DatagramProtocol):
             "protover": 3,
             "client": "openanidb",
             "clientver": 2,
+            # Ask for our address as the server sees it, and set the
+            # encoding in the same round trip rather than with ENCODING.
+            "nat": 1,
+            "enc": "UTF8",
+            # Let long replies be compressed, so that they fit in a
+            # datagram.
+            "comp": 1,
         }
 
-        payload = request("AUTH", data)
-        self.write(payload)
-
-        d = self.ds()
+        d = self.call("AUTH", data)
 
         @d.addCallback
         def check(t):
@@ -165,10 +521,11 @@ class AniDBProtocol(DatagramProtocol):
 
             if code == 200 or code == 201:
                 # LOGIN ACCEPTED
-                session, stuff = data.split(" ", 1)
+                session, self.nat, stuff = data.split(" ", 2)
                 self.session = session
 
-                log.msg("Logged in; session %s" % session)
+                log.msg("Logged in; session %s from %s"
+                        % (session, self.nat))
             elif code == 500:
                 # LOGIN FAILED
                 raise Exception("Login failed")
@@ -181,20 +538,14 @@ class AniDBProtocol(DatagramProtocol):
         if not self.session:
             return fail("Already logged out.")
 
-        payload = request("LOGOUT", {"s": self.session})
-        self.write(payload)
-
-        return self.ds()
+        return self.call("LOGOUT", {"s": self.session})
 
     def encoding(self):
         data = {
             "s": self.session,
             "name": "UTF8",
         }
-        payload = request("ENCODING", data)
-        self.write(payload)
-
-        d = self.ds()
+        d = self.call("ENCODING", data)
 
         @d.addCallback
         def check(t):
@@ -212,10 +563,7 @@ class AniDBProtocol(DatagramProtocol):
         return d
 
     def version(self):
-        payload = request("VERSION")
-        self.write(payload)
-
-        d = self.ds()
+        d = self.call("VERSION")
 
         @d.addCallback
         def check(t):
@@ -237,10 +585,7 @@ class AniDBProtocol(DatagramProtocol):
         if not self.session:
             return fail("Log in before checking uptime.")
 
-        payload = request("UPTIME", {"s": self.session})
-        self.write(payload)
-
-        d = self.ds()
+        d = self.call("UPTIME", {"s": self.session})
 
         @d.addCallback
         def check(t):
@@ -260,19 +605,29 @@ class AniDBProtocol(DatagramProtocol):
 
         return d
 
-    def lookup(self, size, ed2k):
+    # The fields asked for about each file, and about its anime, in the
+    # order that they come back after the file ID.
+    fmask = "00c0010000"
+    file_keys = ["size", "ed2k", "fext"]
+    amask = "c020c040"
+    anime_keys = ["eid_total", "eid_highest", "series", "eid", "title",
+                  "group"]
+
+    def _file(self, size, ed2k, fmask, amask, keys):
+        """
+        Ask about a file, returning a Deferred which fires with a dict of
+        the file ID and the given keys.
+        """
+
         data = {
             "ed2k": ed2k,
             "size": size,
-            "amask": "c020c040",
-            "fmask": "00c0010000",
+            "amask": amask,
+            "fmask": fmask,
             "s": self.session,
         }
 
-        payload = request("FILE", data)
-        self.write(payload)
-
-        d = self.ds()
+        d = self.call("FILE", data)
 
         @d.addCallback
         def check(t):
@@ -281,38 +636,69 @@ class AniDBProtocol(DatagramProtocol):
             if code == 220:
                 # FILE
                 fragments = data.split("\n")[1].split("|")
-                keys = [
-                    "fid",
-                    "size",
-                    "ed2k",
-                    "fext",
-                    "eid_total",
-                    "eid_highest",
-                    "series",
-                    "eid",
-                    "title",
-                    "group",
-                ]
-                d = dict(zip(keys, fragments))
-
-                for k in ("eid", "eid_highest", "eid_total", "fid", "size"):
-                    d[k] = int(d[k])
-
-                return d
+                if len(fragments) < len(keys) + 1:
+                    raise TruncatedReply(code, data)
+                return dict(zip(["fid"] + keys, fragments))
             elif code == 320:
                 # NO SUCH FILE
                 raise FileNotFound()
 
         return d
 
+    def lookup(self, size, ed2k):
+        d = self._file(size, ed2k, self.fmask, self.amask,
+                       self.file_keys + self.anime_keys)
+
+        @d.addErrback
+        def split(failure):
+            # Too much to fit in one reply; ask for the file's and the
+            # anime's fields separately.
+            failure.trap(TruncatedReply)
+            log.msg("Asking about %s in two parts" % ed2k)
+
+            d = gatherResults([
+                self._file(size, ed2k, self.fmask, "00000000",
+                           self.file_keys),
+                self._file(size, ed2k, "0000000000", self.amask,
+                           self.anime_keys),
+            ], consumeErrors=True)
+
+            @d.addCallback
+            def merge(parts):
+                info, anime = parts
+                info.update(anime)
+                return info
+
+            d.addErrback(lambda f: f.value.subFailure)
+            return d
+
+        @d.addCallback
+        def convert(info):
+            if info is not None:
+                for k in ("eid", "eid_highest", "eid_total", "fid", "size"):
+                    info[k] = int(info[k])
+            return info
+
+        return d
+
+
+SERVER = "api.anidb.info", 9000
+
+
+def make_protocol(reactor, port=0, server=SERVER, limits=None):
+    """
+    Resolve the AniDB server and start talking to it from a local port.
+
+    limits are passed along to Trickling, to change the rate limits.
+    """
 
-def make_protocol(reactor):
-    d = reactor.resolve("api.anidb.info")
+    host, server_port = server
+    d = reactor.resolve(host)
 
     @d.addCallback
     def cb(address):
-        protocol = AniDBProtocol(reactor, address)
-        reactor.listenUDP(0, protocol)
+        protocol = AniDBProtocol(reactor, address, server_port, limits)
+        protocol.port = reactor.listenUDP(port, protocol)
         return protocol
 
     return d
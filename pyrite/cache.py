@@ -0,0 +1,252 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+On-disk caches, so that re-runs don't have to redo work.
+"""
+
+import json
+import os
+import sqlite3
+
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.python import log
+
+from pyrite.helpers import utf8
+from pyrite.metrics import metrics
+
+
+def identity(path):
+    """
+    Get the identity of a file on disk: its device, inode, size, and
+    modification time.
+
+    If any of these change, then the file has changed and anything computed
+    from its contents is stale.
+    """
+
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
+
+class HashCache(object):
+    """
+    A cache of file digests, keyed by file identity.
+
+    Digests are stored per kind ("ed2k", "osdb", etc.) so that gurus which
+    need different digests can share a single cache.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS hashes (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        path BLOB NOT NULL,
+        kind TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (dev, ino, kind)
+    )
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute(self.schema)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, filepath):
+        """
+        Retrieve all cached digests for a file, as a dict of kinds to
+        digests.
+
+        Entries which were recorded for a different version of the file are
+        thrown away.
+        """
+
+        dev, ino, size, mtime = identity(filepath.path)
+
+        rows = self._db.execute("""
+            SELECT size, mtime, kind, digest FROM hashes
+            WHERE dev = ? AND ino = ?
+        """, (dev, ino)).fetchall()
+
+        digests = {}
+        stale = False
+
+        for row_size, row_mtime, kind, digest in rows:
+            if row_size == size and row_mtime == mtime:
+                digests[str(kind)] = str(digest)
+            else:
+                stale = True
+
+        if stale:
+            log.msg("Invalidating cached hashes for %r" % filepath.path)
+            self._db.execute("""
+                DELETE FROM hashes
+                WHERE dev = ? AND ino = ? AND (size != ? OR mtime != ?)
+            """, (dev, ino, size, mtime))
+            self._db.commit()
+
+        return digests
+
+    def put(self, filepath, digests):
+        """
+        Store a dict of kinds to digests for a file.
+        """
+
+        dev, ino, size, mtime = identity(filepath.path)
+        path = sqlite3.Binary(filepath.path)
+
+        self._db.executemany("""
+            INSERT OR REPLACE INTO hashes
+            (dev, ino, size, mtime, path, kind, digest)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(dev, ino, size, mtime, path, kind, digest)
+              for kind, digest in digests.items()])
+        self._db.commit()
+
+    def prune(self):
+        """
+        Remove entries for files which have been deleted or changed.
+
+        Returns the number of files whose entries were removed.
+        """
+
+        rows = self._db.execute("""
+            SELECT DISTINCT dev, ino, size, mtime, path FROM hashes
+        """).fetchall()
+
+        stale = []
+
+        for dev, ino, size, mtime, path in rows:
+            try:
+                current = identity(str(path))
+            except OSError:
+                current = None
+
+            if current != (dev, ino, size, mtime):
+                stale.append((dev, ino))
+
+        self._db.executemany("DELETE FROM hashes WHERE dev = ? AND ino = ?",
+                             stale)
+        self._db.commit()
+
+        return len(stale)
+
+
+class LookupCache(object):
+    """
+    A cache of what gurus had to say about files, keyed by guru and by file
+    size and hash.
+
+    A missing answer is stored as None, meaning that the guru didn't know of
+    the file.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS lookups (
+        guru TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        data TEXT,
+        stamp REAL NOT NULL,
+        PRIMARY KEY (guru, size, hash)
+    )
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute(self.schema)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, guru, size, hash):
+        """
+        Retrieve a pair of the time an answer was stored, and the answer, or
+        None if nothing was stored.
+        """
+
+        row = self._db.execute("""
+            SELECT stamp, data FROM lookups
+            WHERE guru = ? AND size = ? AND hash = ?
+        """, (guru, size, hash)).fetchone()
+
+        if row is None:
+            return None
+
+        stamp, data = row
+        if data is not None:
+            data = utf8(json.loads(data))
+
+        return stamp, data
+
+    def put(self, guru, size, hash, data, stamp):
+        if data is not None:
+            data = json.dumps(data)
+
+        self._db.execute("""
+            INSERT OR REPLACE INTO lookups (guru, size, hash, data, stamp)
+            VALUES (?, ?, ?, ?, ?)
+        """, (guru, size, hash, data, stamp))
+        self._db.commit()
+
+    def prune(self, before):
+        """
+        Remove answers stored before a given time.
+
+        Returns the number of answers removed.
+        """
+
+        cursor = self._db.execute("DELETE FROM lookups WHERE stamp < ?",
+                                  (before,))
+        self._db.commit()
+        return cursor.rowcount
+
+
+def cached(cache, filepath, kind, f):
+    """
+    Get a single kind of digest for a file, consulting a cache first.
+
+    On a miss, f is called with the filepath and should return a dict of
+    kinds to digests, or a Deferred which fires with one. Every digest it
+    returns is stored, not just the one which was asked for, so that a later
+    request for another kind need not read the file again. The cache may be
+    None, in which case f is always called.
+
+    Returns a Deferred which fires with the digest. The cache itself is only
+    touched from the calling thread, even if f hashes in another one.
+    """
+
+    if cache is not None:
+        digests = cache.get(filepath)
+        if kind in digests:
+            metrics.count("hash_cache_hits")
+            return succeed(digests[kind])
+        metrics.count("hash_cache_misses")
+
+    d = maybeDeferred(f, filepath)
+
+    @d.addCallback
+    def cb(digests):
+        if cache is not None:
+            cache.put(filepath, digests)
+        return digests[kind]
+
+    return d
@@ -20,3 +20,18 @@ class MultipleMatches(Exception):
     """
     Why can't I hold all these matches?
     """
+
+class TimedOut(Exception):
+    """
+    The server never answered.
+    """
+
+class TruncatedReply(Exception):
+    """
+    A reply was too long, and was cut short.
+    """
+
+class VerificationFailed(Exception):
+    """
+    A copied file doesn't match its original.
+    """
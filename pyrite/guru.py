@@ -11,14 +11,26 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from twisted.internet.defer import fail, inlineCallbacks
-from zope.interface import Interface, implements
-
-from pyrite.anidb import make_protocol
+import os
+
+from twisted.internet.defer import (CancelledError, Deferred, fail,
+                                    gatherResults, inlineCallbacks, succeed)
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import Attribute, Interface, implements
+
+from pyrite.anidb import (SERVER, SessionExpired, load_session,
+                          make_protocol, save_session)
+from pyrite.cache import cached
 from pyrite.errors import FileNotFound, MultipleMatches
-from pyrite.hashing import size_and_hash
+from pyrite.hashing import hash_file
 from pyrite.helpers import remap_keys
-from pyrite.osdb import OSDB, derphash
+from pyrite.metrics import metrics
+from pyrite.munger import parse
+from pyrite.osdb import API, OSDB, Batcher, derphash
+from pyrite.parallel import ThreadedHasher
 
 
 class NotLoggedIn(Exception):
@@ -27,6 +39,16 @@ class NotLoggedIn(Exception):
     """
 
 
+def osdb_hash(filepath):
+    """
+    Compute only the OpenSubtitles hash, which needs just 128 KiB of the
+    file rather than the whole thing.
+    """
+
+    with filepath.open("rb") as handle:
+        return {"osdb": derphash(handle)}
+
+
 class IGuru(Interface):
     """
     A knower of truth and file hashes.
@@ -42,50 +64,182 @@ class IGuru(Interface):
         pass
 
 
+class IHashingGuru(IGuru):
+    """
+    A guru which looks files up by their size and a hash of their contents.
+    """
+
+    name = Attribute("A short name for the guru, like 'anidb'.")
+
+    def fingerprint(filepath):
+        """
+        Get the size and hash of a file, as a Deferred pair.
+        """
+
+    def search(size, hash):
+        """
+        Look up a file by its size and hash.
+        """
+
+
 class AniDBGuru(object):
 
-    implements(IGuru)
+    implements(IHashingGuru)
+
+    name = "anidb"
 
     _p = None
+    _keepalive = None
+    _waiters = None
+
+    def __init__(self, cache=None, hasher=hash_file, max_hashes=1,
+                 session_file=None, server=SERVER, limits=None):
+        self._cache = cache
+        self._hasher = hasher
+        self._max_hashes = max_hashes
+        self._session_file = session_file
+        self._server = server
+        self._limits = limits
 
     @inlineCallbacks
     def start(self, reactor, username, password):
-        self._p = p = yield make_protocol(reactor)
-
-        yield p.login(username, password)
-        yield p.encoding()
+        self._threads = ThreadedHasher(reactor, self._max_hashes)
+        self._credentials = username, password
+
+        saved = None
+        if self._session_file:
+            saved = load_session(self._session_file, reactor.seconds())
+
+        if saved:
+            # The session is tied to our address, so it can only be reused
+            # from the same local port.
+            try:
+                self._p = p = yield make_protocol(reactor, saved["port"],
+                                                  self._server, self._limits)
+            except CannotListenError:
+                log.msg("Port %d is busy; not reusing session"
+                        % saved["port"])
+                saved = None
+            else:
+                p.session = str(saved["session"])
+                log.msg("Reusing session %s" % p.session)
+
+        if not saved:
+            self._p = p = yield make_protocol(reactor, 0, self._server,
+                                              self._limits)
+            yield p.login(username, password)
+
+        self._keepalive = LoopingCall(p.keepalive)
+        self._keepalive.clock = reactor
+        self._keepalive.start(60, now=False)
 
     def stop(self):
         if self._p:
-            d = self._p.logout()
+            self._p.report()
+
+            if self._keepalive is not None and self._keepalive.running:
+                self._keepalive.stop()
+
+            if self._session_file:
+                # Leave the session open for the next run.
+                save_session(self._session_file, self._p.session,
+                             self._p.port.getHost().port, self._p.active)
+                log.msg("Saved session %s" % self._p.session)
+                d = succeed(None)
+            else:
+                d = self._p.logout()
+
             @d.addCallback
             def cb(chaff):
-                self._p = None
+                port, self._p = self._p.port, None
+                return port.stopListening()
             return d
 
         return fail(NotLoggedIn())
 
-    def lookup(self, filepath):
+    def _login(self):
+        """
+        Log in again, once, no matter how many lookups noticed that the
+        session had expired.
+        """
+
+        if self._waiters is None:
+            self._waiters = []
+            d = self._p.login(*self._credentials)
+
+            @d.addBoth
+            def done(result):
+                waiters, self._waiters = self._waiters, None
+                for waiter in waiters:
+                    waiter.callback(result)
+
+        waiter = Deferred()
+        self._waiters.append(waiter)
+        return waiter
+
+    def fingerprint(self, filepath):
+        if self._p:
+            size = filepath.getsize()
+            # Hash everything in one pass while the file is being read
+            # anyway; if another guru needs a different digest later, it
+            # can come out of the cache.
+            d = cached(self._cache, filepath, "ed2k",
+                       lambda fp: self._threads.run(self._hasher, fp))
+            d.addCallback(lambda hash: (size, hash))
+            return d
+
+        return fail(NotLoggedIn())
+
+    def search(self, size, hash):
         if self._p:
-            data = size_and_hash(filepath)
-            return self._p.lookup(*data)
+            d = self._p.lookup(size, hash)
+
+            @d.addErrback
+            def expired(failure):
+                failure.trap(SessionExpired)
+                log.msg("Session expired; logging in again")
+                d = self._login()
+                d.addCallback(lambda chaff: self._p.lookup(size, hash))
+                return d
+
+            return d
 
         return fail(NotLoggedIn())
 
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+        d.addCallback(lambda t: self.search(*t))
+        return d
+
 
 class OSDBGuru(object):
 
-    implements(IGuru)
+    implements(IHashingGuru)
+
+    name = "osdb"
 
     _db = None
 
+    def __init__(self, cache=None, max_hashes=1, batch_window=0.5,
+                 batch_limit=100, api=API):
+        self._api = api
+        self._cache = cache
+        self._max_hashes = max_hashes
+        self._batch_window = batch_window
+        self._batch_limit = batch_limit
+
     def start(self, reactor, username, password):
+        self._threads = ThreadedHasher(reactor, self._max_hashes)
+
         # Annoyingly, the XML-RPC Proxy doesn't parameterize the reactor.
-        self._db = OSDB()
+        self._db = OSDB(self._api)
+        self._batcher = Batcher(reactor, self._db, self._batch_window,
+                                self._batch_limit)
         return self._db.login(username, password)
 
     def stop(self):
         if self._db:
+            self._batcher.flush()
             d = self._db.logout()
             @d.addCallback
             def cb(chaff):
@@ -94,17 +248,25 @@ class OSDBGuru(object):
 
         return fail(NotLoggedIn())
 
-    def lookup(self, filepath):
+    def fingerprint(self, filepath):
         if self._db:
             # Files shorter than 128KiB will not be in the database. As a
             # hack, this also prevents files shorter than 64KiB from breaking
             # the hashing algorithm. Derpy but works.
-            if filepath.getsize() < 128 * 1024:
+            size = filepath.getsize()
+            if size < 128 * 1024:
                 return fail(FileNotFound())
 
-            with filepath.open("rb") as handle:
-                derp = derphash(handle)
-            d = self._db.search(derp)
+            d = cached(self._cache, filepath, "osdb",
+                       lambda fp: self._threads.run(osdb_hash, fp))
+            d.addCallback(lambda derp: (size, derp))
+            return d
+
+        return fail(NotLoggedIn())
+
+    def search(self, size, derp):
+        if self._db:
+            d = self._batcher.search(derp)
 
             @d.addCallback
             def cb(data):
@@ -131,3 +293,356 @@ class OSDBGuru(object):
             return d
 
         return fail(NotLoggedIn())
+
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+        d.addCallback(lambda t: self.search(*t))
+        return d
+
+
+class CachingGuru(object):
+    """
+    A guru which remembers what another guru said about each file, including
+    when it said that there was no such file.
+
+    Answers are kept in a LookupCache, keyed by the wrapped guru's name and
+    the file's size and hash, for positive_ttl seconds, or negative_ttl
+    seconds for files which weren't found.
+    """
+
+    implements(IHashingGuru)
+
+    def __init__(self, guru, cache, positive_ttl=30 * 24 * 60 * 60,
+                 negative_ttl=24 * 60 * 60):
+        self._g = guru
+        self._cache = cache
+        self._positive_ttl = positive_ttl
+        self._negative_ttl = negative_ttl
+
+    def start(self, reactor, username, password):
+        self._reactor = reactor
+        return self._g.start(reactor, username, password)
+
+    def stop(self):
+        return self._g.stop()
+
+    @property
+    def name(self):
+        return self._g.name
+
+    def fingerprint(self, filepath):
+        return self._g.fingerprint(filepath)
+
+    def search(self, size, hash):
+        now = self._reactor.seconds()
+        entry = self._cache.get(self._g.name, size, hash)
+
+        if entry is not None:
+            stamp, data = entry
+            if data is None:
+                if now - stamp < self._negative_ttl:
+                    metrics.count("lookup_cache_hits")
+                    return fail(FileNotFound())
+            elif now - stamp < self._positive_ttl:
+                metrics.count("lookup_cache_hits")
+                return succeed(data)
+
+        metrics.count("lookup_cache_misses")
+        d = self._g.search(size, hash)
+
+        def found(data):
+            self._cache.put(self._g.name, size, hash, data, now)
+            return data
+
+        def not_found(failure):
+            failure.trap(FileNotFound)
+            self._cache.put(self._g.name, size, hash, None, now)
+            return failure
+
+        d.addCallbacks(found, not_found)
+        return d
+
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+        d.addCallback(lambda t: self.search(*t))
+        return d
+
+
+class Shared(object):
+    """
+    The result of a Deferred, handed to any number of waiters.
+
+    Each waiter gets its own copy of a dict result, so that callers can
+    change what they're given. Waiters can be cancelled; once none are left,
+    the Deferred itself is cancelled.
+    """
+
+    _result = None
+
+    def __init__(self, d):
+        self._d = d
+        self._waiters = []
+        d.addBoth(self._fire)
+
+    def _fire(self, result):
+        self._result = result
+        waiters, self._waiters = self._waiters, None
+        for waiter in waiters:
+            self._give(waiter)
+        return result
+
+    def _give(self, d):
+        result = self._result
+        if isinstance(result, Failure):
+            d.errback(result)
+        elif isinstance(result, dict):
+            d.callback(dict(result))
+        else:
+            d.callback(result)
+
+    def _cancel(self, d):
+        self._waiters.remove(d)
+        if not self._waiters:
+            self._d.cancel()
+
+    def wait(self):
+        if self._waiters is None:
+            d = Deferred()
+            self._give(d)
+        else:
+            d = Deferred(self._cancel)
+            self._waiters.append(d)
+        return d
+
+
+class DedupingGuru(object):
+    """
+    A guru which notices files that it has already seen during this run.
+
+    Files which are links to the same inode are hashed once, and files with
+    the same size and hash are searched for once. Every file after the first
+    with a given size and hash has "duplicate" set in its data.
+    """
+
+    implements(IHashingGuru)
+
+    def __init__(self, guru):
+        self._g = guru
+        self._fingerprints = {}
+        self._searches = {}
+        self._firsts = {}
+
+    def start(self, reactor, username, password):
+        return self._g.start(reactor, username, password)
+
+    def stop(self):
+        return self._g.stop()
+
+    @property
+    def name(self):
+        return self._g.name
+
+    def _shared(self, memo, key, f, *args):
+        """
+        Call f once per key. Answers that a file isn't known are kept, but
+        other failures are forgotten, so that they can be retried later on.
+        """
+
+        if key in memo:
+            return memo[key].wait()
+
+        d = f(*args)
+        shared = memo[key] = Shared(d)
+        # Wait before forgetting, since d might already have failed.
+        waiting = shared.wait()
+
+        @d.addErrback
+        def forget(failure):
+            # The waiters have their own copies of the failure.
+            if not failure.check(FileNotFound, MultipleMatches):
+                del memo[key]
+
+        return waiting
+
+    def fingerprint(self, filepath):
+        try:
+            st = os.stat(filepath.path)
+        except OSError:
+            return fail()
+        return self._shared(self._fingerprints, (st.st_dev, st.st_ino),
+                            self._g.fingerprint, filepath)
+
+    def search(self, size, hash):
+        return self._shared(self._searches, (size, hash), self._g.search,
+                            size, hash)
+
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+
+        @d.addCallback
+        def cb((size, hash)):
+            first = self._firsts.setdefault((size, hash), filepath.path)
+            d = self.search(size, hash)
+            if first != filepath.path:
+                metrics.count("duplicates")
+                d.addCallback(self._mark)
+            return d
+
+        return d
+
+    def _mark(self, data):
+        data["duplicate"] = True
+        return data
+
+
+class FilenameGuru(object):
+    """
+    A guru which reads TV episodes' series, season, and episode numbers from
+    their filenames, without going to the network.
+
+    Filenames which can't be parsed are passed to a fallback guru, if there
+    is one. There's no episode title in a filename, so the series name
+    stands in for it.
+    """
+
+    implements(IGuru)
+
+    name = "filename"
+
+    def __init__(self, fallback=None):
+        self._fallback = fallback
+
+    def start(self, reactor, username, password):
+        if self._fallback is not None:
+            return self._fallback.start(reactor, username, password)
+        return succeed(None)
+
+    def stop(self):
+        if self._fallback is not None:
+            return self._fallback.stop()
+        return succeed(None)
+
+    def lookup(self, filepath):
+        info = parse(filepath.basename())
+
+        if info is None:
+            if self._fallback is not None:
+                return self._fallback.lookup(filepath)
+            return fail(FileNotFound())
+
+        name, (season, episode), ext = info
+        return succeed({
+            "series": name,
+            "title": name,
+            "sid": season,
+            "eid": episode,
+        })
+
+
+class RacingGuru(object):
+    """
+    A guru which asks several other gurus about each file, and goes with the
+    first good answer.
+
+    By default, every guru is asked at once, and the others are cancelled as
+    soon as one answers. If ordered is set, they're asked one at a time, in
+    order, and each is only asked if those before it had no answer.
+
+    Answers are tagged with the name of the guru which gave them, under
+    "guru", since different gurus give different keys.
+    """
+
+    implements(IGuru)
+
+    def __init__(self, gurus, ordered=False):
+        self._gurus = gurus
+        self._ordered = ordered
+
+    def start(self, reactor, username, password):
+        return gatherResults([guru.start(reactor, username, password)
+                              for guru in self._gurus], consumeErrors=True)
+
+    def stop(self):
+        return gatherResults([guru.stop() for guru in self._gurus],
+                             consumeErrors=True)
+
+    def _tag(self, data, guru):
+        log.msg("%s answered first" % guru.name)
+        metrics.count("race_wins_%s" % guru.name)
+        data["guru"] = guru.name
+        return data
+
+    def _verdict(self, failures):
+        """
+        Pick the most telling of several gurus' failures.
+
+        A file which one guru has several matches for is more interesting
+        than one which nobody knows, and any other error is more interesting
+        still.
+        """
+
+        for failure in failures:
+            if not failure.check(FileNotFound, MultipleMatches):
+                return failure
+        for failure in failures:
+            if failure.check(MultipleMatches):
+                return failure
+        return failures[0]
+
+    def _in_order(self, filepath):
+        failures = []
+
+        def attempt(gurus):
+            if not gurus:
+                return self._verdict(failures)
+
+            guru = gurus[0]
+            d = guru.lookup(filepath)
+            d.addCallback(self._tag, guru)
+
+            @d.addErrback
+            def eb(failure):
+                failures.append(failure)
+                return attempt(gurus[1:])
+
+            return d
+
+        return attempt(self._gurus)
+
+    def _race(self, filepath):
+        failures = []
+        racers = []
+
+        def cancel(d):
+            for racer in racers:
+                racer.cancel()
+
+        result = Deferred(cancel)
+
+        def won(data, guru):
+            if not result.called:
+                result.callback(self._tag(data, guru))
+                cancel(result)
+
+        def lost(failure, guru):
+            if failure.check(CancelledError) and result.called:
+                return
+            failures.append(failure)
+            if len(failures) == len(self._gurus):
+                result.errback(self._verdict(failures))
+
+        for guru in self._gurus:
+            if result.called:
+                # Somebody already answered.
+                break
+            d = guru.lookup(filepath)
+            racers.append(d)
+            d.addCallbacks(won, lost, callbackArgs=(guru,),
+                           errbackArgs=(guru,))
+
+        return result
+
+    def lookup(self, filepath):
+        if self._ordered:
+            return self._in_order(filepath)
+        return self._race(filepath)
@@ -14,33 +14,200 @@
 # under the License.
 
 """
-An implementation of ED2K.
+An implementation of ED2K, and of hashing files in general.
 """
 
+from hashlib import md5, sha1
+from mmap import ACCESS_READ, mmap
+from zlib import crc32
+
 from Crypto.Hash import MD4
 
+from pyrite.metrics import metrics
+from pyrite.osdb import checksum
+
+# The ED2K leaf size.
+CHUNK = 9728000
+
+# The size of each of the blocks summed by the OpenSubtitles hash.
+BLOCK = 64 * 1024
+
+
+def readinto_full(handle, buf):
+    """
+    Fill buf from handle, stopping early only at the end of the file.
+
+    Returns the number of bytes read.
+    """
+
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        count = handle.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def chunks(handle, size=CHUNK, use_mmap=False):
+    """
+    Iterate over the contents of a handle in pieces of the given size.
+
+    The pieces are read-only buffers over a single reused bytearray (or over
+    a memory map, if use_mmap is set), so memory use doesn't depend on the
+    size of the file. Each piece is only valid until the next one is
+    requested; copy it if it needs to be kept.
 
-def ed2k(handle):
+    Handles without readinto(), like StringIO, are read normally.
+    """
+
+    if use_mmap:
+        try:
+            mapped = mmap(handle.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped, and have nothing to hash anyway.
+            return
+
+        try:
+            for offset in xrange(0, len(mapped), size):
+                yield buffer(mapped, offset, size)
+        finally:
+            mapped.close()
+        return
+
+    if not hasattr(handle, "readinto"):
+        while True:
+            piece = handle.read(size)
+            if piece == '':
+                break
+            yield piece
+        return
+
+    buf = bytearray(size)
+    while True:
+        count = readinto_full(handle, buf)
+        if not count:
+            break
+        yield buffer(buf, 0, count)
+
+
+def ed2k(handle, use_mmap=False):
     """
     ED2K is a rudimentary tree hash, with a depth of 1 and a leaf size of
     9,728,000 bytes. The hash is MD4, which is not natively available in
     Python, so I use PyCrypto's version instead.
     """
 
-    buf = ''
-    hashl = []
-    while True:
-        buf = handle.read(9728000)
-        if buf == '':
-            break
-        hashl.append(MD4.new(buf).digest())
-    hashed = MD4.new(''.join(hashl)).hexdigest()
-    return hashed
+    root = MD4.new()
+    for piece in chunks(handle, use_mmap=use_mmap):
+        root.update(MD4.new(piece).digest())
+    return root.hexdigest()
 
 
 def size_and_hash(filepath):
+    done = metrics.timer("hash_seconds")
     size = filepath.getsize()
     handle = filepath.open("rb")
     hash = ed2k(handle)
     handle.close()
+    done()
+    metrics.count("hashed_bytes", size)
     return size, hash
+
+
+class MultiHasher(object):
+    """
+    A streaming hasher which computes several digests at once.
+
+    Feed the entire contents of a file, in order and in pieces of any size,
+    to update(); digests() then gives ED2K, the OpenSubtitles hash, CRC32,
+    MD5, and SHA1 without the file ever being read twice.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+        self._leaf = MD4.new()
+        self._leaf_size = 0
+        self._root = MD4.new()
+
+        self._crc = 0
+        self._md5 = md5()
+        self._sha1 = sha1()
+
+        self._head = ""
+        self._tail = ""
+
+    def update(self, data):
+        self.size += len(data)
+
+        self._crc = crc32(data, self._crc)
+        self._md5.update(data)
+        self._sha1.update(data)
+
+        # Slicing copies, so only slice off as much as needs to be kept.
+        if len(self._head) < BLOCK:
+            self._head += data[:BLOCK - len(self._head)]
+
+        if len(data) >= BLOCK:
+            self._tail = data[-BLOCK:]
+        else:
+            self._tail = (self._tail + data[:])[-BLOCK:]
+
+        # Split the data along ED2K leaf boundaries, without copying.
+        offset = 0
+        while offset < len(data):
+            length = min(CHUNK - self._leaf_size, len(data) - offset)
+            self._leaf.update(buffer(data, offset, length))
+            self._leaf_size += length
+            offset += length
+
+            if self._leaf_size == CHUNK:
+                self._root.update(self._leaf.digest())
+                self._leaf = MD4.new()
+                self._leaf_size = 0
+
+    def digests(self):
+        """
+        Get a dict of digest names to hex digests.
+
+        The OpenSubtitles hash, "osdb", is only present if at least 64 KiB
+        were hashed.
+        """
+
+        root = self._root.copy()
+        if self._leaf_size:
+            root.update(self._leaf.digest())
+
+        rv = {
+            "ed2k": root.hexdigest(),
+            "crc32": "%08x" % (self._crc & 0xffffffff),
+            "md5": self._md5.hexdigest(),
+            "sha1": self._sha1.hexdigest(),
+        }
+
+        if self.size >= BLOCK:
+            i = checksum(self._head) + checksum(self._tail) + self.size
+            rv["osdb"] = "%016x" % (i % 2 ** 64)
+
+        return rv
+
+
+def digests(handle, use_mmap=False):
+    """
+    Hash a handle with every supported digest, in a single pass.
+    """
+
+    done = metrics.timer("hash_seconds")
+    hasher = MultiHasher()
+    for piece in chunks(handle, use_mmap=use_mmap):
+        hasher.update(piece)
+    done()
+    metrics.count("hashed_bytes", hasher.size)
+    return hasher.digests()
+
+
+def hash_file(filepath, use_mmap=False):
+    with filepath.open("rb") as handle:
+        return digests(handle, use_mmap=use_mmap)
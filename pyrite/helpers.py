@@ -18,3 +18,18 @@ def remap_keys(m, d):
     """
 
     return dict((v, d[k]) for k, v in m.items())
+
+
+def utf8(o):
+    """
+    Turn the unicode that json gives back into the UTF-8 strs that gurus
+    give out.
+    """
+
+    if isinstance(o, unicode):
+        return o.encode("utf-8")
+    elif isinstance(o, dict):
+        return dict((utf8(k), utf8(v)) for k, v in o.items())
+    elif isinstance(o, list):
+        return [utf8(v) for v in o]
+    return o
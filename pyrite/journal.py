@@ -0,0 +1,225 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+An append-only journal of what happened to each file during runs, so that
+an interrupted run can be resumed and a finished one undone.
+
+The journal is newline-delimited JSON, one entry per line, synced to disk
+as each entry is written. Each entry has an event, the path of the file it
+concerns, and the time:
+
+ * planned: the file is about to be looked up
+ * found: the file was looked up, and its data is recorded
+ * moved: the file was put at its target, using some placement
+ * skipped: the file was left alone, for some reason
+ * undone: a move was undone
+
+Run "python -m pyrite.journal undo JOURNAL" to undo every move in a
+journal, newest first.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+import json
+import os
+import sys
+import time
+
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+from pyrite.helpers import utf8
+from pyrite.transfer import place_file
+
+# Events after which there's nothing left to do for a file.
+finished = "moved", "skipped"
+
+# Paths are bytes, which needn't be valid UTF-8, so they're kept in the
+# journal as Latin-1, which any bytes can round-trip through.
+path_fields = "path", "target"
+
+
+def read(path):
+    """
+    Iterate over the entries in a journal.
+
+    A torn final line, from a run which died while writing it, is ignored.
+    """
+
+    with open(path, "rb") as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                log.msg("Ignoring torn journal entry %r" % line)
+                continue
+
+            for field in path_fields:
+                if field in entry:
+                    entry[field] = entry[field].encode("latin-1")
+            yield utf8(entry)
+
+
+def replay(entries):
+    """
+    Find the latest entry for each file.
+    """
+
+    return dict((entry["path"], entry) for entry in entries)
+
+
+class Journal(object):
+    """
+    A journal file, open for appending.
+
+    When resuming, the entries already in the journal are read first, so
+    that the state each file was left in can be looked up with previous().
+    """
+
+    def __init__(self, path, resume=False):
+        self._previous = {}
+        if resume and os.path.exists(path):
+            self._previous = replay(read(path))
+
+        self._handle = open(path, "ab")
+
+    def close(self):
+        self._handle.close()
+
+    def previous(self, filepath):
+        """
+        Get the latest entry for a file from before this run, or None.
+        """
+
+        return self._previous.get(filepath.path)
+
+    def record(self, event, filepath, **fields):
+        """
+        Append an entry, and make sure that it's on disk before returning.
+
+        Any fields which are FilePaths are stored as their paths.
+        """
+
+        entry = {"event": event, "path": filepath, "stamp": time.time()}
+        entry.update(fields)
+
+        for field in path_fields:
+            if field in entry:
+                entry[field] = entry[field].path.decode("latin-1")
+
+        self._handle.write(json.dumps(entry, sort_keys=True) + "\n")
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+
+def undo(path, dry_run=False):
+    """
+    Undo every move in a journal which hasn't been undone yet, newest first.
+
+    Files which were moved are moved back. Files which were placed while
+    keeping their originals have their new copies or links removed, as long
+    as the originals are still there.
+
+    Returns the number of moves undone, or which would have been.
+    """
+
+    entries = list(read(path))
+
+    # Targets with undone entries which haven't yet been matched up with
+    # the moves that they undid. Each undone entry only cancels the newest
+    # move to its target before it, since later runs may put files there
+    # again.
+    undone = Counter()
+
+    journal = Journal(path)
+    count = 0
+
+    for entry in reversed(entries):
+        if entry["event"] == "undone":
+            undone[entry["target"]] += 1
+            continue
+        if entry["event"] != "moved":
+            continue
+        if undone[entry["target"]]:
+            undone[entry["target"]] -= 1
+            continue
+
+        source = FilePath(entry["path"])
+        target = FilePath(entry["target"])
+        placement = entry.get("placement", "move")
+
+        if not os.path.lexists(target.path):
+            log.msg("Missing, can't undo: %r" % target.path)
+            continue
+
+        if placement == "move":
+            if source.exists():
+                log.msg("In the way, can't undo: %r" % source.path)
+                continue
+            log.msg("Moving back %r to %r" % (target.path, source.path))
+        elif source.exists():
+            log.msg("Removing %r" % target.path)
+        elif placement == "symlink":
+            log.msg("Original is gone, can't undo: %r" % target.path)
+            continue
+        else:
+            # The original went away since; don't lose the only copy.
+            log.msg("Moving back %r to %r" % (target.path, source.path))
+            placement = "move"
+
+        count += 1
+        if dry_run:
+            continue
+
+        if placement == "move":
+            parent = source.parent()
+            if not parent.exists():
+                parent.makedirs()
+            place_file(target, source, "move")
+        else:
+            os.unlink(target.path)
+
+        journal.record("undone", source, target=target)
+
+    journal.close()
+    return count
+
+
+def argv_parser():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    undo_parser = subparsers.add_parser("undo",
+                                        help="Undo every move in a journal")
+    undo_parser.add_argument("-n", "--dry-run",
+                             help="Only say what would be undone",
+                             action="store_true")
+    undo_parser.add_argument("journal")
+    return parser
+
+
+def main():
+    args = argv_parser().parse_args()
+    log.startLogging(sys.stdout)
+
+    if args.command == "undo":
+        count = undo(args.journal, dry_run=args.dry_run)
+        if args.dry_run:
+            print "Would undo %d moves" % count
+        else:
+            print "Undid %d moves" % count
+
+
+if __name__ == "__main__":
+    main()
@@ -14,21 +14,182 @@
 from argparse import (ArgumentDefaultsHelpFormatter,
                       RawDescriptionHelpFormatter, ArgumentParser)
 import sys
+import time
 
-from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import react
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import LoopingCall, react
 from twisted.python import log
 from twisted.python.filepath import FilePath
 
-from pyrite.guru import AniDBGuru, OSDBGuru
+from pyrite.cache import HashCache, LookupCache
+from pyrite.guru import (AniDBGuru, CachingGuru, DedupingGuru, FilenameGuru,
+                         OSDBGuru, RacingGuru)
+from pyrite.journal import Journal
+from pyrite.manifest import Manifest
+from pyrite.metrics import metrics
 from pyrite.namer import Namer
+from pyrite.parallel import ProcessHasher
+from pyrite.profiling import profiled
+from pyrite.transfer import Mover, placements
+from pyrite.walker import Walker
+from pyrite.watch import Watcher
 
 gurus = {
     "anidb": AniDBGuru,
     "osdb": OSDBGuru,
 }
 
-def pick_style(args):
+# The guru and formatter for each preset.
+styles = {
+    "anime": ("anidb",
+              "{series}/{series} - {eid:02d} - {title} - [{group}].{fext}"),
+    "movie": ("osdb", "{title} ({year}).{ext}"),
+    "tv": ("osdb", "{sid:02d}x{eid:02d} - {title}.{ext}"),
+}
+
+
+def make_cache(args):
+    """
+    From command-line arguments, open the hash cache.
+
+    Without an on-disk cache, a cache is still kept in memory for the length
+    of the run, so that files are read at most once.
+    """
+
+    if not args.hash_cache:
+        if args.prune_cache:
+            print "WARNING: No hash cache specified; nothing to prune"
+        return HashCache(":memory:")
+
+    cache = HashCache(args.hash_cache)
+    print "Using hash cache: %s" % args.hash_cache
+
+    if args.prune_cache:
+        pruned = cache.prune()
+        print "Pruned %d stale files from hash cache" % pruned
+
+    return cache
+
+
+def make_lookup_cache(args):
+    """
+    From command-line arguments, open the lookup cache, if one was requested.
+    """
+
+    if not args.lookup_cache:
+        return None
+
+    cache = LookupCache(args.lookup_cache)
+    print "Using lookup cache: %s" % args.lookup_cache
+
+    if args.prune_cache:
+        ttl = max(args.positive_ttl, args.negative_ttl) * 24 * 60 * 60
+        pruned = cache.prune(time.time() - ttl)
+        print "Pruned %d expired entries from lookup cache" % pruned
+
+    return cache
+
+
+def make_manifest(args):
+    """
+    From command-line arguments, open the manifest, if one was requested.
+    """
+
+    if not args.manifest:
+        return None
+
+    print "Using manifest: %s" % args.manifest
+    return Manifest(args.manifest)
+
+
+def make_journal(args):
+    """
+    From command-line arguments, open the journal, if one was requested.
+    """
+
+    if not args.journal:
+        if args.resume:
+            raise ValueError("--resume needs a --journal to resume from")
+        return None
+
+    if args.dry_run:
+        print "WARNING: Dry run; not writing journal"
+        return None
+
+    print "Using journal: %s" % args.journal
+    if args.resume:
+        print "Resuming from journal"
+    return Journal(args.journal, resume=args.resume)
+
+
+def make_walker(args):
+    """
+    From command-line arguments, decide which files are worth naming.
+    """
+
+    max_size = None
+    if args.max_size is not None:
+        max_size = args.max_size * 1024
+
+    return Walker(extensions=args.extensions, min_size=args.min_size * 1024,
+                  max_size=max_size, include=args.include,
+                  exclude=args.exclude)
+
+
+def make_hasher(args):
+    """
+    From command-line arguments, determine how files will be hashed.
+    """
+
+    if args.workers > 1:
+        print "Using %d hashing processes" % args.workers
+        return ProcessHasher(args.workers)
+
+    return None
+
+
+def make_guru(name, args, cache=None, hasher=None):
+    """
+    From command-line arguments, make the named guru.
+    """
+
+    kwargs = {"cache": cache, "max_hashes": args.max_hashes}
+    if name == "anidb":
+        kwargs["session_file"] = args.session_file
+        # Only AniDB reads whole files; OSDB just needs their ends.
+        if hasher is not None:
+            kwargs["hasher"] = hasher.digests
+            # Each hash in flight keeps at most one worker busy, unless the
+            # file is big enough to be split up.
+            kwargs["max_hashes"] = max(args.max_hashes, hasher.workers)
+
+    return gurus[name](**kwargs)
+
+
+def wrap_guru(guru, args, lookups=None, offline=False):
+    """
+    From command-line arguments, wrap a guru with a lookup cache, and, for
+    TV, with offline naming if that was asked for.
+
+    Copies of the same file are always hashed and looked up only once.
+    """
+
+    if lookups is not None:
+        guru = CachingGuru(guru, lookups,
+                           positive_ttl=args.positive_ttl * 24 * 60 * 60,
+                           negative_ttl=args.negative_ttl * 24 * 60 * 60)
+
+    guru = DedupingGuru(guru)
+
+    if offline and args.offline:
+        # Most episodes say which they are in their names; only ask OSDB
+        # about the rest.
+        guru = FilenameGuru(guru)
+
+    return guru
+
+
+def pick_style(args, cache=None, hasher=None):
     """
     From command-line arguments, determine which guru and formatter to use.
     """
@@ -36,15 +197,9 @@ def pick_style(args):
     guru = None
     formatter = None
 
-    if args.anime:
-        guru = "anidb"
-        formatter = "{series}/{series} - {eid:02d} - {title} - [{group}].{fext}"
-    elif args.movie:
-        guru = "osdb"
-        formatter = "{title} ({year}).{ext}"
-    elif args.tv:
-        guru = "osdb"
-        formatter = "{sid:02d}x{eid:02d} - {title}.{ext}"
+    for preset in "anime", "movie", "tv":
+        if getattr(args, preset):
+            guru, formatter = styles[preset]
 
     if not guru:
         print "WARNING: Guru not specified; defaulting to OSDB"
@@ -58,35 +213,120 @@ def pick_style(args):
     print "Using formatter: %r" % formatter
     print "Using guru: %s" % guru
 
-    guru = gurus[guru]()
+    guru = make_guru(guru, args, cache, hasher)
 
     return guru, formatter
 
 
+def make_race(args, cache=None, hasher=None, lookups=None):
+    """
+    From command-line arguments, set up several presets' gurus to race each
+    other, and a dict of their names to their presets' formatters.
+    """
+
+    racers = []
+    formatters = {}
+
+    for preset in args.race:
+        name, formatter = styles[preset]
+        guru = make_guru(name, args, cache, hasher)
+        guru = wrap_guru(guru, args, lookups, offline=preset == "tv")
+
+        if guru.name in formatters:
+            raise ValueError("Can't race %s against itself" % guru.name)
+
+        racers.append(guru)
+        formatters[guru.name] = formatter
+        print "Using guru %s with formatter %r" % (guru.name, formatter)
+
+    if args.ordered:
+        print "Asking gurus in order"
+    else:
+        print "Racing gurus"
+
+    return RacingGuru(racers, ordered=args.ordered), formatters
+
+
 def main():
     args = argv_parser()
 
+    cache = make_cache(args)
+    # The process pool has to be created before the reactor starts, so that
+    # the workers don't inherit it.
+    hasher = make_hasher(args)
+
+    lookups = make_lookup_cache(args)
+
     # Determine which guru and formatter we're using.
-    guru, formatter = pick_style(args)
+    if args.race:
+        guru, formatter = make_race(args, cache, hasher, lookups)
+    else:
+        guru, formatter = pick_style(args, cache, hasher)
+        guru = wrap_guru(guru, args, lookups, offline=args.tv)
 
     source = FilePath(args.source)
     dest = FilePath(args.dest)
 
+    from twisted.internet import reactor
+    mover = Mover(reactor, transfers=args.transfers, cache=cache,
+                  verify=args.verify, placement=args.placement)
+
+    if hasher is not None:
+        reactor.addSystemEventTrigger("after", "shutdown", hasher.close)
+
     namer = Namer(guru, formatter, dry_run=args.dry_run, replace=args.replace,
-                  slash=args.slash)
+                  slash=args.slash, concurrency=args.concurrency,
+                  manifest=make_manifest(args), mover=mover,
+                  journal=make_journal(args), duplicates=args.duplicates,
+                  walker=make_walker(args))
 
     log.startLogging(sys.stdout)
-    react(react_main, (guru, namer, source, dest, args))
+
+    if args.profile:
+        # react() always exits, so the report is printed on the way out.
+        profiled(args.profile, react, react_main,
+                 (guru, namer, source, dest, args))
+    else:
+        react(react_main, (guru, namer, source, dest, args))
 
 
 @inlineCallbacks
 def react_main(reactor, guru, namer, source, dest, args):
+    if args.metrics and args.metrics_interval:
+        dumper = LoopingCall(metrics.dump, args.metrics)
+        dumper.clock = reactor
+        dumper.start(args.metrics_interval, now=False)
+
     yield guru.start(reactor, args.username, args.password)
 
+    stopped = Deferred()
+
     try:
-        yield namer.rename(source, dest)
+        if args.watch:
+            watcher = Watcher(reactor, namer, source, dest,
+                              settle=args.settle,
+                              concurrency=args.concurrency)
+            # Watching only ends when the reactor is asked to stop; hold it
+            # up until the files in progress are done with, and the guru has
+            # been stopped cleanly.
+            def shutdown():
+                d = watcher.stop()
+                d.addCallback(lambda chaff: stopped)
+                return d
+
+            reactor.addSystemEventTrigger("before", "shutdown", shutdown)
+            yield watcher.start()
+        else:
+            yield namer.rename(source, dest)
     finally:
         yield guru.stop()
+        stopped.callback(None)
+
+        if args.metrics:
+            if args.metrics_interval:
+                dumper.stop()
+            metrics.dump(args.metrics)
+            log.msg("Wrote metrics to %r" % args.metrics)
 
 
 formatter_help = """
@@ -112,6 +352,9 @@ Additional keys for "anidb":
     * eid_total: Total number of episodes
     * eid_highest: Highest known episode number
     * group: Name of subtitle or release group
+
+With --race, each file is formatted with the formatter of the preset whose
+guru named it.
 """
 
 
@@ -139,6 +382,82 @@ def argv_parser():
     parser.add_argument("-s", "--slash",
                         help="Character which replaces forward slashes",
                         default="~")
+    parser.add_argument("--hash-cache",
+                        help="SQLite file for caching file hashes")
+    parser.add_argument("--prune-cache",
+                        help="Remove stale entries from the caches",
+                        action="store_true")
+    parser.add_argument("--lookup-cache",
+                        help="SQLite file for caching guru answers")
+    parser.add_argument("--positive-ttl",
+                        help="Days to remember files which were found",
+                        type=float, default=30)
+    parser.add_argument("--negative-ttl",
+                        help="Days to remember files which weren't found",
+                        type=float, default=1)
+    parser.add_argument("--manifest",
+                        help="SQLite file recording already-named files")
+    parser.add_argument("--journal",
+                        help="File recording each step of the run, for "
+                             "resuming or undoing it")
+    parser.add_argument("--resume",
+                        help="Skip the steps which the journal says an "
+                             "earlier run already did",
+                        action="store_true")
+    parser.add_argument("--session-file",
+                        help="File for keeping AniDB sessions between runs")
+    parser.add_argument("-j", "--workers",
+                        help="Number of processes to hash files with",
+                        type=int, default=1)
+    parser.add_argument("-c", "--concurrency",
+                        help="Number of files to process at once",
+                        type=int, default=8)
+    parser.add_argument("--max-hashes",
+                        help="Number of files to hash at once; at least "
+                             "--workers, with more than one",
+                        type=int, default=2)
+    parser.add_argument("-p", "--placement",
+                        help="How to put files in place; all but move keep "
+                             "the originals",
+                        choices=sorted(placements), default="move")
+    parser.add_argument("--duplicates",
+                        help="What to do with copies of a file which was "
+                             "already named: leave them, replace them with "
+                             "hardlinks to it, or name them with numbers",
+                        choices=["skip", "hardlink", "number"],
+                        default="skip")
+    parser.add_argument("--transfers",
+                        help="Number of files to copy between filesystems "
+                             "at once",
+                        type=int, default=2)
+    parser.add_argument("--verify",
+                        help="Check files copied between filesystems "
+                             "against their hashes before removing them",
+                        action="store_true")
+    parser.add_argument("--offline",
+                        help="With --tv, don't look up files whose names "
+                             "say which episode they are; they get their "
+                             "series name in place of an episode title",
+                        action="store_true")
+    parser.add_argument("--metrics",
+                        help="File to write timings and counters to at "
+                             "exit; a Prometheus textfile if it ends in "
+                             ".prom, otherwise JSON")
+    parser.add_argument("--metrics-interval",
+                        help="Also write metrics every this many seconds "
+                             "(0 for only at exit)",
+                        type=float, default=0)
+    parser.add_argument("--profile",
+                        help="Profile the run, saving pstats to this file "
+                             "and printing the hottest functions")
+    parser.add_argument("-w", "--watch",
+                        help="Keep running, and name new files as they "
+                             "arrive in source (Linux only)",
+                        action="store_true")
+    parser.add_argument("--settle",
+                        help="Seconds a new file must be left alone before "
+                             "it is named",
+                        type=float, default=5)
     presets = parser.add_mutually_exclusive_group()
     presets.add_argument("--anime",
                          help="Use AniDB and simple anime name formatting",
@@ -149,6 +468,33 @@ def argv_parser():
     presets.add_argument("--tv",
                          help="Use OSDB and simple tv name formatting",
                          action="store_true")
+    presets.add_argument("--race",
+                         help="Race this preset's guru against others, "
+                              "naming each file with whichever answers "
+                              "first; give more than once",
+                         action="append", choices=sorted(styles))
+    parser.add_argument("--ordered",
+                        help="With --race, ask gurus one at a time, in the "
+                             "order given",
+                        action="store_true")
+    parser.add_argument("--extensions",
+                        help="Only name files with these extensions",
+                        nargs="+")
+    parser.add_argument("--min-size",
+                        help="Skip files smaller than this many KiB",
+                        type=int, default=0)
+    parser.add_argument("--max-size",
+                        help="Skip files larger than this many KiB",
+                        type=int)
+    parser.add_argument("--include",
+                        help="Only name files matching this glob; may be "
+                             "given more than once",
+                        action="append", default=[])
+    parser.add_argument("--exclude",
+                        help="Skip files and directories matching this "
+                             "glob, like *.nfo or Sample; may be given "
+                             "more than once",
+                        action="append", default=[])
     parser.add_argument("username")
     parser.add_argument("password")
     parser.add_argument("source")
@@ -0,0 +1,113 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+A record of which files have already been dealt with, so that re-runs over
+a library can skip them.
+"""
+
+import os.path
+import sqlite3
+import time
+
+from pyrite.cache import identity
+
+
+class Manifest(object):
+    """
+    A persistent manifest of processed files.
+
+    Each file is recorded along with its identity, what happened to it, and
+    where it was put.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        path BLOB PRIMARY KEY,
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        result TEXT NOT NULL,
+        target BLOB,
+        stamp REAL NOT NULL
+    )
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute(self.schema)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, filepath):
+        """
+        Retrieve the identity, result, and target path recorded for a file,
+        or None if it was never recorded.
+        """
+
+        row = self._db.execute("""
+            SELECT dev, ino, size, mtime, result, target FROM files
+            WHERE path = ?
+        """, (sqlite3.Binary(filepath.path),)).fetchone()
+
+        if row is None:
+            return None
+
+        dev, ino, size, mtime, result, target = row
+        if target is not None:
+            target = str(target)
+
+        return (dev, ino, size, mtime), str(result), target
+
+    def record(self, filepath, result, target=None):
+        """
+        Record what happened to a file, which must still exist.
+        """
+
+        dev, ino, size, mtime = identity(filepath.path)
+        if target is not None:
+            target = sqlite3.Binary(target.path)
+
+        self._db.execute("""
+            INSERT OR REPLACE INTO files
+            (path, dev, ino, size, mtime, result, target, stamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (sqlite3.Binary(filepath.path), dev, ino, size, mtime, result,
+              target, time.time()))
+        self._db.commit()
+
+    def done(self, filepath):
+        """
+        Whether a file is unchanged since it was recorded, and is already
+        where it belongs, or was kept after being put there.
+        """
+
+        entry = self.get(filepath)
+        if entry is None:
+            return False
+
+        recorded, result, target = entry
+        if result == "kept":
+            if target is None or not os.path.lexists(target):
+                return False
+        elif target != filepath.path:
+            return False
+
+        try:
+            return identity(filepath.path) == recorded
+        except OSError:
+            return False
@@ -0,0 +1,153 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Counters and latency histograms for the stages of a run, so that slow runs
+can be pinned on hashing, rate limiting, the network, or moving files.
+
+Everything is recorded in a single process-wide registry, metrics, which is
+safe to use from the hashing threads.
+"""
+
+from bisect import bisect_left
+import json
+import os
+from threading import Lock
+import time
+
+# Upper bounds of the latency histograms' buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Histogram(object):
+    """
+    Counts of observations falling into each of a fixed set of buckets,
+    along with their total.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One more, for everything beyond the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Pairs of bucket bounds and the number of observations no greater than
+        them, ending with infinity and the total count.
+        """
+
+        total = 0
+        rv = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            rv.append((bound, total))
+        return rv
+
+
+class Metrics(object):
+    """
+    A registry of named counters and histograms.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def timer(self, name):
+        """
+        Get a function which, when called, records the time since this
+        function was called.
+        """
+
+        start = time.time()
+        return lambda: self.observe(name, time.time() - start)
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def as_json(self):
+        with self._lock:
+            return json.dumps({
+                "counters": self.counters,
+                "histograms": dict((name, {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "buckets": [[str(bound), n]
+                                for bound, n in h.cumulative()],
+                }) for name, h in self.histograms.items()),
+            }, indent=2, sort_keys=True)
+
+    def as_prometheus(self, prefix="pyrite_"):
+        """
+        Render everything in the Prometheus text format.
+        """
+
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append("# TYPE %s%s counter" % (prefix, name))
+                lines.append("%s%s %s" % (prefix, name, value))
+
+            for name, h in sorted(self.histograms.items()):
+                lines.append("# TYPE %s%s histogram" % (prefix, name))
+                for bound, n in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('%s%s_bucket{le="%s"} %d'
+                                 % (prefix, name, le, n))
+                lines.append("%s%s_sum %r" % (prefix, name, h.sum))
+                lines.append("%s%s_count %d" % (prefix, name, h.count))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """
+        Write everything to a file, as a Prometheus textfile if its name ends
+        in ".prom" and as JSON otherwise.
+
+        The file is replaced atomically, so that collectors never see it
+        half-written.
+        """
+
+        if path.endswith(".prom"):
+            data = self.as_prometheus()
+        else:
+            data = self.as_json()
+
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp, "wb") as handle:
+            handle.write(data)
+        os.rename(temp, path)
+
+
+metrics = Metrics()
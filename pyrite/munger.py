@@ -12,9 +12,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import os.path
+import re
 import sys
 
-from parsley import makeGrammar
+from parsley import ParseError, makeGrammar
 
 g = """
 boundary = " - " | '.' -> " - "
@@ -39,6 +40,42 @@ tv = name:n ep:e trash* extension:ext -> (n, e, ext)
 
 Munger = makeGrammar(g, {})
 
+# The common, dotted spelling of the grammar above, as a regular expression.
+# It only accepts names which the grammar would parse the same way; anything
+# else, like names with " - " in them, is left to the grammar.
+fast = re.compile(r"""
+    ^(?P<name>[A-Za-z]+(?:\.[A-Za-z]+)*)\.
+    (?:S(?P<s>\d{2})E(?P<e>\d{2})|(?P<xs>\d{1,2})[Xx](?P<xe>\d{1,2}))\.
+    (?:(?:HDTV|x264-[^a-z. ]+)\.)*
+    (?P<ext>[^.]{3,4})$
+""", re.VERBOSE)
+
+def parse(filename):
+    """
+    Parse a TV episode's filename into its series name, (season, episode)
+    pair, and extension, or return None if it can't be parsed.
+    """
+
+    match = fast.match(filename)
+    if match is not None:
+        name, s, e, xs, xe, ext = match.group("name", "s", "e", "xs", "xe",
+                                              "ext")
+        if s is None:
+            s, e = xs, xe
+        return name.replace(".", " "), (int(s), int(e)), ext
+
+    try:
+        return Munger(filename).tv()
+    except ParseError:
+        return None
+
+def parse_many(filenames):
+    """
+    Parse many filenames at once, as parse() does.
+    """
+
+    return [parse(filename) for filename in filenames]
+
 def makeX(info):
     name, ep, ext = info
     season, ep = ep
@@ -46,10 +83,12 @@ def makeX(info):
 
 def main():
     argv = sys.argv[2:]
-    for name in argv:
-        folder, filename = os.path.split(name)
-        munged = makeX(Munger(filename).tv())
-        print "Old:", filename, "New:", munged
+    filenames = [os.path.basename(name) for name in argv]
+    for filename, info in zip(filenames, parse_many(filenames)):
+        if info is None:
+            print "Couldn't parse:", filename
+            continue
+        print "Old:", filename, "New:", makeX(info)
 
 if __name__ == "__main__":
     main()
@@ -11,10 +11,21 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from twisted.internet.defer import inlineCallbacks
+from itertools import count
+import os.path
+
+from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
+                                    returnValue, succeed)
+from twisted.internet.task import cooperate
 from twisted.python import log
+from twisted.python.filepath import FilePath
 
-from pyrite.errors import FileNotFound, MultipleMatches
+from pyrite.errors import (FileNotFound, MultipleMatches, TimedOut,
+                           TruncatedReply, VerificationFailed)
+from pyrite.journal import finished
+from pyrite.metrics import metrics
+from pyrite.transfer import replace_with_link
+from pyrite.walker import Walker
 
 
 def make_target(filepath, data, s):
@@ -36,11 +47,24 @@ class Namer(object):
     _dr = True
     _replace = False
     _slash = "~"
+    _concurrency = 1
+    _duplicates = "skip"
 
     def __init__(self, guru, formatter, dry_run=None, replace=None,
-                 slash=None):
+                 slash=None, concurrency=None, manifest=None, mover=None,
+                 journal=None, duplicates=None, walker=None):
         self._g = guru
         self._f = formatter
+        self._manifest = manifest
+        self._mover = mover
+        self._journal = journal
+        self.walker = walker or Walker()
+
+        # Targets which files are being put at, each with a list of
+        # Deferreds waiting for that to be done, and targets which files
+        # were put at during this run.
+        self._placing = {}
+        self._placed = set()
 
         if dry_run is not None:
             self._dr = dry_run
@@ -51,6 +75,12 @@ class Namer(object):
         if slash is not None:
             self._slash = slash
 
+        if concurrency is not None:
+            self._concurrency = concurrency
+
+        if duplicates is not None:
+            self._duplicates = duplicates
+
     def _rename(self, source, target):
         """
         Move a file from one location to another, if they aren't the same path.
@@ -73,9 +103,23 @@ class Namer(object):
         if not parent.exists():
             log.msg("Making directory %r" % parent.path)
             parent.makedirs()
+
+        done = metrics.timer("place_seconds")
+
+        if self._mover is not None:
+            d = self._mover.move(source, target)
+
+            @d.addCallback
+            def cb(chaff):
+                done()
+                metrics.count("files_placed")
+                return True
+            return d
+
         log.msg("Moving %r to %r" % (source.path, target.path))
         source.moveTo(target)
-
+        done()
+        metrics.count("files_placed")
         return True
 
     def _lookup(self, source):
@@ -102,18 +146,222 @@ class Namer(object):
         root, ext = filepath.splitext()
         data["ext"] = ext[1:]
 
+    def formatter(self, data):
+        """
+        Pick the formatter for some data.
+
+        The formatter may be a dict of guru names to formatters, for data
+        tagged by a RacingGuru with the guru which it came from.
+        """
+
+        if isinstance(self._f, dict):
+            return self._f[data["guru"]]
+        return self._f
+
+    @inlineCallbacks
+    def process(self, path, dest):
+        """
+        Look up a single file and rename it into dest.
+        """
+
+        if self._manifest is not None and self._manifest.done(path):
+            log.msg("%r is unchanged since it was named" % path.path)
+            return
+
+        previous = None
+        if self._journal is not None:
+            previous = self._journal.previous(path)
+            if previous is not None and previous["event"] in finished:
+                log.msg("%r was dealt with by an earlier run" % path.path)
+                return
+
+        try:
+            if previous is not None and previous["event"] == "found":
+                log.msg("%r was looked up by an earlier run" % path.path)
+                data = previous["data"]
+            else:
+                data = yield self._journaled_lookup(path)
+            # Set by a DedupingGuru for copies of files already seen.
+            duplicate = data.pop("duplicate", False)
+            self.augment(data, path)
+            target = make_target(dest, data, self.formatter(data))
+            if duplicate:
+                yield self._duplicate(path, target)
+            else:
+                moved = yield self._place(path, target)
+                self._record(path, target, moved)
+        except FileNotFound:
+            log.msg("File %r not found" % path.path)
+            metrics.count("files_not_found")
+            self._record(path, None, False, "notfound")
+        except MultipleMatches:
+            log.msg("Can't deal with multiple matches yet")
+            metrics.count("files_multiple_matches")
+            self._record(path, None, False, "multiple")
+        except TruncatedReply:
+            log.msg("The answer about %r was too long" % path.path)
+            self._record(path, None, False, "truncated")
+        except TimedOut:
+            log.msg("Gave up waiting to hear about %r" % path.path)
+            metrics.count("files_timed_out")
+            self._record(path, None, False, "timedout")
+        except VerificationFailed as e:
+            log.msg("Not moving %r: %s" % (path.path, e))
+        except OSError as e:
+            log.msg("OS error: %s" % e)
+
+    def _after(self, target):
+        """
+        Wait until nothing is being put at target.
+        """
+
+        waiters = self._placing.get(target.path)
+        if waiters is None:
+            return succeed(None)
+
+        d = Deferred()
+        waiters.append(d)
+        return d
+
+    @inlineCallbacks
+    def _place(self, path, target):
+        """
+        Rename a file, after anything else on its way to the same target.
+        """
+
+        while target.path in self._placing:
+            yield self._after(target)
+
+        self._placing[target.path] = []
+        try:
+            moved = yield self._rename(path, target)
+        finally:
+            for waiter in self._placing.pop(target.path):
+                waiter.callback(None)
+
+        if moved:
+            self._placed.add(target.path)
+        returnValue(moved)
+
+    def _numbered(self, target):
+        """
+        Find the first free target like "name (2).ext".
+        """
+
+        root, ext = os.path.splitext(target.basename())
+        for i in count(2):
+            numbered = target.sibling("%s (%d)%s" % (root, i, ext))
+            if not numbered.exists() and numbered.path not in self._placing:
+                return numbered
+
     @inlineCallbacks
+    def _duplicate(self, path, target):
+        """
+        Deal with a file identical to one which was already named, once
+        that one has been put in place.
+        """
+
+        metrics.count("files_duplicate")
+
+        while target.path in self._placing:
+            yield self._after(target)
+
+        if self._duplicates == "number":
+            target = self._numbered(target)
+            moved = yield self._place(path, target)
+            self._record(path, target, moved)
+            return
+
+        if self._duplicates == "hardlink" and target.path in self._placed:
+            if self._dr:
+                log.msg("Dry-run; not hardlinking duplicate %r to %r"
+                        % (path.path, target.path))
+            else:
+                log.msg("Hardlinking duplicate %r to %r"
+                        % (path.path, target.path))
+                replace_with_link(target, path)
+        else:
+            log.msg("%r is a duplicate; leaving it" % path.path)
+
+        self._record(path, None, False, "duplicate")
+
+    def _journaled_lookup(self, path):
+        """
+        Look up a file, noting the lookup and its result in the journal, if
+        there is one.
+        """
+
+        if self._journal is None:
+            return self._lookup(path)
+
+        self._journal.record("planned", path)
+        d = self._lookup(path)
+
+        @d.addCallback
+        def cb(data):
+            self._journal.record("found", path, data=data)
+            return data
+
+        return d
+
+    def _record(self, path, target, moved, result=None):
+        """
+        Note what happened to a file in the manifest and the journal, if
+        there are either.
+        """
+
+        if not moved:
+            if path == target:
+                result = "named"
+            else:
+                result = result or "skipped"
+
+        placement = "move"
+        if self._mover is not None:
+            placement = self._mover.placement
+
+        if self._journal is not None:
+            if moved:
+                self._journal.record("moved", path, target=target,
+                                     placement=placement)
+            else:
+                self._journal.record("skipped", path, result=result)
+
+        if self._manifest is None:
+            return
+
+        if moved:
+            # The file is now at its target, so that's what to remember.
+            self._manifest.record(target, "renamed", target)
+            if placement != "move":
+                # So is the original, which is still where it was.
+                self._manifest.record(path, "kept", target)
+        else:
+            self._manifest.record(path, result, target)
+
     def rename(self, source, dest):
-        for path in source.walk():
-            if path.isfile():
-                try:
-                    data = yield self._lookup(path)
-                    self.augment(data, path)
-                    target = make_target(dest, data, self._f)
-                    yield self._rename(path, target)
-                except FileNotFound:
-                    log.msg("File %r not found" % path.path)
-                except MultipleMatches:
-                    log.msg("Can't deal with multiple matches yet")
-                except OSError as e:
-                    log.msg("OS error: %s" % e)
+        """
+        Rename every wanted file under source into dest.
+
+        Several files may be in progress at once, so that one file can be
+        hashed while another is being looked up.
+        """
+
+        work = (self.process(FilePath(found.path), dest)
+                for found in self.walker.walk(source.path))
+
+        # Each task pulls from the same generator, so no more than
+        # _concurrency files are ever in progress.
+        tasks = [cooperate(work).whenDone() for i in range(self._concurrency)]
+
+        # Wait for every task, even after one fails, so that nothing is still
+        # using the guru when the caller stops it.
+        d = DeferredList(tasks, consumeErrors=True)
+
+        @d.addCallback
+        def cb(results):
+            for success, result in results:
+                if not success:
+                    return result
+
+        return d
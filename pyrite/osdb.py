@@ -11,23 +11,73 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
-from struct import Struct
+from struct import unpack_from
+import time
 
+from twisted.internet.defer import Deferred
 from twisted.web.xmlrpc import Proxy
 
 from pyrite.errors import FileNotFound
+from pyrite.metrics import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def checksum(data):
-    s = Struct("<Q")
-    m = 2 ** 64
-    i = 0
+    """
+    Sum data as little-endian 64-bit words, modulo 2**64.
+
+    Any trailing partial word is ignored.
+    """
+
+    count = len(data) // 8
+
+    if numpy is not None:
+        # Unsigned NumPy sums wrap around, which is exactly the modulus.
+        words = numpy.frombuffer(data, dtype="<u8", count=count)
+        return int(words.sum(dtype=numpy.uint64))
+
+    return sum(unpack_from("<%dQ" % count, data)) % 2 ** 64
+
+
+def checksums(blocks):
+    """
+    Checksum many blocks at once.
+
+    Returns a list of checksums, in the same order as the blocks.
+    """
+
+    blocks = list(blocks)
+    if not blocks:
+        return []
+
+    size = len(blocks[0])
+    if numpy is not None and size % 8 == 0 and all(len(block) == size
+                                                   for block in blocks):
+        words = numpy.frombuffer("".join(blocks), dtype="<u8")
+        words = words.reshape(len(blocks), size // 8)
+        return [int(i) for i in words.sum(axis=1, dtype=numpy.uint64)]
+
+    return [checksum(block) for block in blocks]
 
-    for offset in range(0, len(data), s.size):
-        i += s.unpack_from(data, offset=offset)[0]
-        i %= m
 
-    return i
+def ends(handle):
+    """
+    Read the first and last 64 KiB of a handle, and find its size.
+    """
+
+    handle.seek(0, 0)
+    head = handle.read(64 * 1024)
+
+    handle.seek(-64 * 1024, 2)
+    tail = handle.read(64 * 1024)
+
+    size = handle.tell()
+
+    return head, tail, size
 
 
 def derphash(handle):
@@ -42,20 +92,33 @@ def derphash(handle):
     This function seeks; reseek the handle afterwards if necessary.
     """
 
-    m = 2 ** 64
+    return derphashes([handle])[0]
 
-    handle.seek(0, 0)
-    data = handle.read(64 * 1024)
-    i = checksum(data)
 
-    handle.seek(-64 * 1024, 2)
-    data = handle.read(64 * 1024)
-    i += checksum(data)
+def derphashes(handles):
+    """
+    Calculate the unnamed custom hash of many files, checksumming all of
+    their blocks in one go.
 
-    size = handle.tell()
-    i += size
+    The same caveats as derphash() apply to each handle.
+    """
+
+    done = metrics.timer("osdb_hash_seconds")
+    blocks = []
+    sizes = []
 
-    return "%016x" % (i % m)
+    for handle in handles:
+        head, tail, length = ends(handle)
+        blocks.append(head)
+        blocks.append(tail)
+        sizes.append(length)
+
+    sums = checksums(blocks)
+    done()
+    metrics.count("osdb_hashes", len(sizes))
+
+    return ["%016x" % ((sums[2 * i] + sums[2 * i + 1] + size) % 2 ** 64)
+            for i, size in enumerate(sizes)]
 
 
 API = "http://api.opensubtitles.org/xml-rpc"
@@ -88,8 +151,8 @@ class OSDB(object):
 
     token = None
 
-    def __init__(self):
-        self.p = Proxy(API)
+    def __init__(self, api=API):
+        self.p = Proxy(api)
 
     def login(self, username, password):
         d = self.p.callRemote("LogIn", username, password, "und",
@@ -116,14 +179,39 @@ class OSDB(object):
 
         return d
 
-    def search(self, derp):
-        d = self.p.callRemote("CheckMovieHash2", self.token, [derp])
+    def search_many(self, derps):
+        """
+        Look up several hashes in a single request.
+
+        Returns a Deferred which fires with a dict of hashes to lists of
+        matches. Hashes with no matches may be missing from the dict.
+        """
+
+        metrics.count("osdb_searches")
+        metrics.count("osdb_searched_hashes", len(derps))
+        d = self.p.callRemote("CheckMovieHash2", self.token, derps)
+
+        start = time.time()
+
+        @d.addBoth
+        def timed(result):
+            metrics.observe("osdb_search_seconds", time.time() - start)
+            return result
 
         d.addCallback(consider)
 
         @d.addCallback
         def cb(data):
-            vs = data["data"]
+            # An empty result comes back as an empty list, not a dict.
+            return data["data"] or {}
+
+        return d
+
+    def search(self, derp):
+        d = self.search_many([derp])
+
+        @d.addCallback
+        def cb(vs):
             # We only want that first result. Since we asked for only one
             # search, we will get either zero or one results.
             if vs:
@@ -132,3 +220,73 @@ class OSDB(object):
                 raise FileNotFound()
 
         return d
+
+
+class Batcher(object):
+    """
+    Collects searches into batches, so that many files can be looked up in
+    a single request.
+
+    A batch is sent once window seconds have passed since its first search,
+    or as soon as it has limit hashes in it, whichever comes first.
+    """
+
+    _call = None
+
+    def __init__(self, reactor, db, window=0.5, limit=100):
+        self._reactor = reactor
+        self._db = db
+        self._window = window
+        self._limit = limit
+
+        self._pending = {}
+
+    def search(self, derp):
+        """
+        Look up a hash, eventually.
+
+        Returns a Deferred which fires with the list of matches, or fails
+        with FileNotFound.
+        """
+
+        d = Deferred()
+        self._pending.setdefault(derp, []).append(d)
+
+        if len(self._pending) >= self._limit:
+            self.flush()
+        elif self._call is None:
+            self._call = self._reactor.callLater(self._window, self.flush)
+
+        return d
+
+    def flush(self):
+        """
+        Send the current batch right away.
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        d = self._db.search_many(list(pending))
+
+        def cb(results):
+            for derp, ds in pending.items():
+                vs = results.get(derp)
+                for d in ds:
+                    if vs:
+                        d.callback(list(vs))
+                    else:
+                        d.errback(FileNotFound())
+
+        def eb(failure):
+            for ds in pending.values():
+                for d in ds:
+                    d.errback(failure)
+
+        d.addCallbacks(cb, eb)
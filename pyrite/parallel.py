@@ -0,0 +1,148 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Hashing on more than one core.
+"""
+
+from multiprocessing import Pool
+
+from Crypto.Hash import MD4
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.filepath import FilePath
+
+from pyrite.hashing import CHUNK, hash_file
+from pyrite.osdb import derphash
+
+
+# These run in the worker processes, and so must be importable module-level
+# functions taking and returning plain picklable values.
+
+def _leaf(args):
+    path, index = args
+    with open(path, "rb") as handle:
+        handle.seek(index * CHUNK)
+        return MD4.new(handle.read(CHUNK)).digest()
+
+
+def _hash_path(path):
+    return path, hash_file(FilePath(path))
+
+
+def combine(leaves):
+    """
+    Combine ED2K leaf digests, in order, into the final hex digest.
+    """
+
+    root = MD4.new()
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
+
+
+class ProcessHasher(object):
+    """
+    A pool of processes for hashing files.
+
+    Whole files can be hashed concurrently with hash_files(), and a single
+    large file can have its ED2K leaves hashed concurrently with ed2k().
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._pool = Pool(workers)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def hash_files(self, filepaths):
+        """
+        Compute every digest of many files at once.
+
+        Yields pairs of filepaths and digest dicts as each file finishes,
+        which is not necessarily the order in which they were given.
+        """
+
+        paths = [filepath.path for filepath in filepaths]
+        for path, digests in self._pool.imap_unordered(_hash_path, paths):
+            yield FilePath(path), digests
+
+    def ed2k(self, filepath):
+        """
+        Compute the ED2K hash of a single file, hashing its leaves in
+        parallel.
+        """
+
+        count = -(-filepath.getsize() // CHUNK)
+        jobs = [(filepath.path, i) for i in range(count)]
+        return combine(self._pool.map(_leaf, jobs, chunksize=1))
+
+    def digests(self, filepath):
+        """
+        Hash a single file in the pool, using every worker if the file is
+        large enough to have more than one ED2K leaf.
+
+        This blocks until the file is hashed, but may be called from several
+        threads at once to keep several workers busy.
+
+        Large files only get the ED2K and OpenSubtitles hashes; the other
+        digests are inherently serial and would lose all of the speedup.
+        """
+
+        size = filepath.getsize()
+        if size <= CHUNK:
+            path, digests = self._pool.apply(_hash_path, (filepath.path,))
+            return digests
+
+        with filepath.open("rb") as handle:
+            derp = derphash(handle)
+
+        return {"ed2k": self.ed2k(filepath), "osdb": derp}
+
+
+class ThreadedHasher(object):
+    """
+    Runs blocking hash functions on the reactor's thread pool, so that the
+    reactor keeps servicing the network while files are hashed.
+
+    At most limit hashes are in flight at once; the rest wait their turn.
+    """
+
+    def __init__(self, reactor, limit=1):
+        self._reactor = reactor
+        self._sem = DeferredSemaphore(limit)
+
+        # Make sure the thread pool is at least as big as the limit, or else
+        # the limit is meaningless.
+        if limit > reactor.getThreadPool().max:
+            reactor.suggestThreadPoolSize(limit)
+
+    @property
+    def waiting(self):
+        """
+        The number of hashes waiting for a free slot.
+        """
+
+        return len(self._sem.waiting)
+
+    def run(self, f, *args):
+        """
+        Call f with args in a thread, returning a Deferred which fires with
+        its result.
+        """
+
+        return self._sem.run(deferToThreadPool, self._reactor,
+                             self._reactor.getThreadPool(), f, *args)
@@ -0,0 +1,96 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Profiling whole runs, telling the time the reactor spent waiting for
+something to happen apart from the time spent actually working.
+"""
+
+import cProfile
+import pstats
+import resource
+import time
+
+# The calls in which reactors block, waiting for I/O or timers.
+idle_calls = set([
+    "<method 'poll' of 'select.epoll' objects>",
+    "<method 'poll' of 'select.poll' objects>",
+    "<method 'control' of 'select.kqueue' objects>",
+    "<select.select>",
+])
+
+
+def split_idle(stats):
+    """
+    Remove the reactor's blocking calls from some stats.
+
+    Returns the time that was spent in them.
+    """
+
+    idle = 0
+    for key in stats.stats.keys():
+        filename, line, name = key
+        if name in idle_calls:
+            idle += stats.stats.pop(key)[2]
+    stats.total_tt -= idle
+    return idle
+
+
+def cpu_time():
+    """
+    CPU time used by this process so far, in every thread.
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def report(stats, wall, cpu, limit=25):
+    """
+    Print a summary of a profiled run, and its hottest functions.
+    """
+
+    idle = split_idle(stats)
+
+    print "Wall time: %.2fs" % wall
+    print "Reactor idle: %.2fs (%.0f%%)" % (idle, idle * 100 / max(wall, 1e-9))
+    print "CPU time, all threads: %.2fs" % cpu
+    print "Profiled main thread, excluding idle: %.2fs" % stats.total_tt
+
+    stats.sort_stats("tottime").print_stats(limit)
+    stats.sort_stats("cumulative").print_stats(limit)
+
+
+def profiled(path, f, *args, **kwargs):
+    """
+    Call f with args under cProfile, saving the stats to path for pstats or
+    a viewer like SnakeViz, and printing a report afterwards.
+
+    Only the thread which calls f is profiled; time spent hashing in other
+    threads or processes shows up only in the CPU total.
+    """
+
+    profiler = cProfile.Profile()
+    start, start_cpu = time.time(), cpu_time()
+    profiler.enable()
+
+    try:
+        return f(*args, **kwargs)
+    finally:
+        profiler.disable()
+        wall, cpu = time.time() - start, cpu_time() - start_cpu
+
+        profiler.dump_stats(path)
+        print "Wrote profile to %s" % path
+        report(pstats.Stats(profiler), wall, cpu)
@@ -0,0 +1,183 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+An end-to-end benchmark, running the whole pipeline against the fake
+servers in pyrite.tests.fakes over a synthetic corpus.
+
+Run with "python -m pyrite.tests.benchmark --help".
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+import os
+from tempfile import mkdtemp
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import react
+from twisted.python.filepath import FilePath
+
+from pyrite.anidb import AniDBProtocol
+from pyrite.guru import AniDBGuru, OSDBGuru
+from pyrite.hashing import hash_file
+from pyrite.main import react_main
+from pyrite.namer import Namer
+from pyrite.tests.fakes import FakeAniDB, FakeOSDB, listen_anidb, listen_osdb
+
+formatters = {
+    "anidb": "{series}/{series} - {eid:02d} - {title} - [{group}].{fext}",
+    "osdb": "{title} ({year}).{ext}",
+}
+
+# Rate limits which won't get in the way of measuring everything else.
+UNLIMITED = {
+    "short_rate": 1e6,
+    "short_burst": 1e6,
+    "long_rate": 1e6,
+    "long_burst": 1e6,
+}
+
+
+def make_corpus(root, count, size):
+    """
+    Fill a directory with count distinct files of the given size.
+    """
+
+    root.makedirs()
+    paths = []
+    for i in range(count):
+        path = root.child("file%05d.mkv" % i)
+        path.setContent(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def register(paths, anidb=None, osdb=None):
+    """
+    Teach fake servers about files, so that every one of them is found.
+    """
+
+    for i, path in enumerate(paths):
+        digests = hash_file(path)
+        size = path.getsize()
+
+        if anidb is not None:
+            anidb.files[size, digests["ed2k"]] = {
+                "fid": i,
+                "size": size,
+                "ed2k": digests["ed2k"],
+                "fext": "mkv",
+                "eid_total": len(paths),
+                "eid_highest": len(paths),
+                "series": "Series",
+                "eid": i + 1,
+                "title": "Episode %d" % (i + 1),
+                "group": "Group",
+            }
+
+        if osdb is not None and "osdb" in digests:
+            osdb.files[digests["osdb"]] = {
+                "MovieHash": digests["osdb"],
+                "MovieName": "Movie %d" % i,
+                "MovieYear": "2000",
+                "SeriesSeason": "0",
+                "SeriesEpisode": "0",
+            }
+
+
+def make_guru(reactor, name, anidb_port, osdb_port, options):
+    if name == "anidb":
+        limits = None if options.throttle else UNLIMITED
+        return AniDBGuru(server=("127.0.0.1", anidb_port.getHost().port),
+                         limits=limits, max_hashes=options.max_hashes)
+
+    api = "http://127.0.0.1:%d/" % osdb_port.getHost().port
+    return OSDBGuru(api=api, max_hashes=options.max_hashes)
+
+
+@inlineCallbacks
+def run(reactor, options):
+    root = FilePath(mkdtemp())
+    source = root.child("source")
+    dest = root.child("dest")
+
+    try:
+        print "Making %d files of %d bytes..." % (options.files, options.size)
+        paths = make_corpus(source, options.files, options.size)
+
+        anidb = FakeAniDB(reactor, latency=options.latency,
+                          loss=options.loss, bans=options.bans)
+        osdb = FakeOSDB(reactor, latency=options.latency)
+        register(paths, anidb, osdb)
+
+        anidb_port = listen_anidb(reactor, anidb)
+        osdb_port = listen_osdb(reactor, osdb)
+
+        AniDBProtocol.timeout = options.timeout
+
+        guru = make_guru(reactor, options.guru, anidb_port, osdb_port,
+                         options)
+        namer = Namer(guru, formatters[options.guru], dry_run=False,
+                      concurrency=options.concurrency)
+        args = Namespace(username="user", password="pass", watch=False,
+                         metrics=options.metrics, metrics_interval=0)
+
+        start = time.time()
+        yield react_main(reactor, guru, namer, source, dest, args)
+        elapsed = time.time() - start
+
+        renamed = sum(1 for path in dest.walk() if path.isfile())
+        print "%d/%d files renamed in %.2fs: %.1f files/sec" % (
+            renamed, options.files, elapsed, options.files / elapsed)
+
+        yield anidb_port.stopListening()
+        yield osdb_port.stopListening()
+    finally:
+        root.remove()
+
+
+def argv_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--guru", choices=sorted(formatters),
+                        default="anidb")
+    parser.add_argument("--files", help="Number of files", type=int,
+                        default=100)
+    parser.add_argument("--size", help="Size of each file in bytes",
+                        type=int, default=256 * 1024)
+    parser.add_argument("--latency", help="Server latency in seconds",
+                        type=float, default=0.01)
+    parser.add_argument("--loss", help="AniDB packet loss probability",
+                        type=float, default=0)
+    parser.add_argument("--bans", help="Number of AniDB 555 replies",
+                        type=int, default=0)
+    parser.add_argument("--timeout", help="AniDB retransmit timeout",
+                        type=float, default=1)
+    parser.add_argument("--throttle", help="Use AniDB's real rate limits",
+                        action="store_true")
+    parser.add_argument("--concurrency", help="Files in flight", type=int,
+                        default=8)
+    parser.add_argument("--max-hashes", help="Hashes in flight", type=int,
+                        default=2)
+    parser.add_argument("--metrics",
+                        help="Write pyrite's metrics to this file")
+    return parser
+
+
+def main():
+    options = argv_parser().parse_args()
+    react(run, (options,))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+In-process stand-ins for AniDB and OpenSubtitles, for testing and load
+testing without touching the real services.
+"""
+
+from random import Random
+import zlib
+
+from twisted.internet.defer import succeed
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import deferLater
+from twisted.web.server import Site
+from twisted.web.xmlrpc import XMLRPC
+
+from pyrite.anidb import MAX_REPLY
+
+
+class CountingGuru(object):
+    """
+    A guru which titles files after the first letter of their names, and
+    remembers which files it was asked about.
+    """
+
+    def __init__(self):
+        self.lookups = []
+
+    def lookup(self, filepath):
+        self.lookups.append(filepath)
+        return succeed({"title": "Title %s" % filepath.basename()[0]})
+
+
+def unpack(s):
+    """
+    Unpack a str made by pyrite.anidb.pack into a dict.
+    """
+
+    if not s:
+        return {}
+    return dict(pair.split("=", 1) for pair in s.split("&"))
+
+
+class FakeAniDB(DatagramProtocol):
+    """
+    A UDP server speaking just enough of the AniDB API.
+
+    files maps (size, ed2k) pairs to dicts with the keys that
+    AniDBProtocol.lookup returns. Replies are delayed by latency seconds,
+    each incoming packet is dropped with probability loss, and once bans is
+    nonzero, that many packets in a row get a 555 instead of an answer.
+
+    Like the real thing, replies are compressed for clients which asked for
+    that when logging in, and cut short at MAX_REPLY bytes.
+    """
+
+    session = "fakes"
+
+    def __init__(self, reactor, files=None, latency=0, loss=0, bans=0,
+                 seed=0):
+        self.reactor = reactor
+        self.files = files or {}
+        self.latency = latency
+        self.loss = loss
+        self.bans = bans
+
+        self.received = []
+        self.compressing = set()
+        self._random = Random(seed)
+
+    def reply(self, packet, address):
+        if self.latency:
+            self.reactor.callLater(self.latency, self.transport.write,
+                                   packet, address)
+        else:
+            self.transport.write(packet, address)
+
+    def datagramReceived(self, packet, address):
+        self.received.append(packet)
+
+        if self._random.random() < self.loss:
+            return
+
+        command, rest = (packet.rstrip("\n").split(" ", 1) + [""])[:2]
+        data = unpack(rest)
+
+        handler = getattr(self, "do_%s" % command, None)
+        if self.bans:
+            self.bans -= 1
+            answer = "555 BANNED\nFake ban"
+        elif handler is None:
+            answer = "598 UNKNOWN COMMAND"
+        elif command not in ("AUTH", "PING") and \
+                data.get("s") != self.session:
+            answer = "501 LOGIN FIRST"
+        else:
+            answer = handler(data, address)
+
+        if "tag" in data:
+            answer = "%s %s" % (data["tag"], answer)
+
+        if address in self.compressing:
+            answer = "\x00\x00" + zlib.compress(answer)
+
+        self.reply(answer[:MAX_REPLY], address)
+
+    def do_AUTH(self, data, address):
+        if data.get("comp") == "1":
+            self.compressing.add(address)
+        if data.get("nat"):
+            return "200 %s %s:%d LOGIN ACCEPTED" % ((self.session,) +
+                                                     address)
+        return "200 %s LOGIN ACCEPTED" % self.session
+
+    def do_PING(self, data, address):
+        return "300 PONG"
+
+    def do_ENCODING(self, data, address):
+        return "219 ENCODING CHANGED"
+
+    def do_UPTIME(self, data, address):
+        return "208 UPTIME\n1000"
+
+    def do_LOGOUT(self, data, address):
+        return "203 LOGGED OUT"
+
+    def do_FILE(self, data, address):
+        info = self.files.get((int(data["size"]), data["ed2k"]))
+        if info is None:
+            return "320 NO SUCH FILE"
+
+        keys = ["fid"]
+        if data["fmask"] != "0000000000":
+            keys += ["size", "ed2k", "fext"]
+        if data["amask"] != "00000000":
+            keys += ["eid_total", "eid_highest", "series", "eid", "title",
+                     "group"]
+        return "220 FILE\n" + "|".join(str(info[k]) for k in keys)
+
+
+class FakeOSDB(XMLRPC):
+    """
+    An XML-RPC server speaking just enough of the OpenSubtitles API.
+
+    files maps OpenSubtitles hashes to dicts with the keys that
+    CheckMovieHash2 returns for each match. Replies are delayed by latency
+    seconds.
+    """
+
+    token = "fakes"
+
+    def __init__(self, reactor, files=None, latency=0):
+        XMLRPC.__init__(self, allowNone=True)
+        self.reactor = reactor
+        self.files = files or {}
+        self.latency = latency
+
+        self.searches = []
+
+    def _reply(self, data):
+        data["status"] = "200 OK"
+        data["seconds"] = 0.0
+        if self.latency:
+            return deferLater(self.reactor, self.latency, lambda: data)
+        return data
+
+    def xmlrpc_LogIn(self, username, password, language, agent):
+        return self._reply({"token": self.token})
+
+    def xmlrpc_LogOut(self, token):
+        return self._reply({})
+
+    def xmlrpc_CheckMovieHash2(self, token, hashes):
+        self.searches.append(hashes)
+        found = dict((h, [self.files[h]]) for h in hashes if h in self.files)
+        # Like the real thing, an empty result is a list, not a struct.
+        return self._reply({"data": found or []})
+
+
+def listen_anidb(reactor, server):
+    """
+    Start a FakeAniDB on a free local port, returning the listening port.
+    """
+
+    return reactor.listenUDP(0, server, interface="127.0.0.1")
+
+
+def listen_osdb(reactor, server):
+    """
+    Start a FakeOSDB on a free local port, returning the listening port.
+    """
+
+    return reactor.listenTCP(0, Site(server), interface="127.0.0.1")
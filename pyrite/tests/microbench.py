@@ -0,0 +1,261 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Microbenchmarks for the hot paths: hashing, checksumming, filename parsing,
+and target naming.
+
+Each benchmark runs in its own process, so that its peak memory can be
+measured on its own. Results can be saved as JSON and compared against an
+earlier run.
+
+Run with "python -m pyrite.tests.microbench --help".
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from multiprocessing import Process, Queue
+import json
+import os
+import resource
+from tempfile import mkdtemp
+import time
+
+from twisted.python.filepath import FilePath
+
+from pyrite.hashing import ed2k, hash_file
+from pyrite.munger import Munger, parse_many
+from pyrite.namer import make_target
+from pyrite.osdb import checksum, derphash
+
+MB = 1024 * 1024
+
+
+def make_file(path, size, sparse):
+    """
+    Make a file of the given size, either sparse (all holes, so reading it
+    costs no disk I/O) or full of random data.
+    """
+
+    with open(path, "wb") as handle:
+        if sparse:
+            if size:
+                handle.seek(size - 1)
+                handle.write("\x00")
+        else:
+            remaining = size
+            while remaining:
+                piece = min(remaining, 8 * MB)
+                handle.write(os.urandom(piece))
+                remaining -= piece
+
+
+def timed(f, seconds):
+    """
+    Call f repeatedly for about the given number of seconds, at least once.
+
+    Returns the number of calls and the time they took.
+    """
+
+    calls = 0
+    start = time.time()
+    while True:
+        f()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return calls, elapsed
+
+
+def bench_ed2k(path, size, seconds):
+    def f():
+        with open(path, "rb") as handle:
+            ed2k(handle)
+    calls, elapsed = timed(f, seconds)
+    return {"mb_per_s": calls * size / MB / elapsed}
+
+
+def bench_ed2k_mmap(path, size, seconds):
+    def f():
+        with open(path, "rb") as handle:
+            ed2k(handle, use_mmap=True)
+    calls, elapsed = timed(f, seconds)
+    return {"mb_per_s": calls * size / MB / elapsed}
+
+
+def bench_hash_file(path, size, seconds):
+    filepath = FilePath(path)
+    calls, elapsed = timed(lambda: hash_file(filepath), seconds)
+    return {"mb_per_s": calls * size / MB / elapsed}
+
+
+def bench_checksum(path, size, seconds):
+    block = os.urandom(64 * 1024)
+    calls, elapsed = timed(lambda: checksum(block), seconds)
+    return {"ops_per_s": calls / elapsed}
+
+
+def bench_derphash(path, size, seconds):
+    def f():
+        with open(path, "rb") as handle:
+            derphash(handle)
+    calls, elapsed = timed(f, seconds)
+    return {"ops_per_s": calls / elapsed}
+
+
+NAMES = [
+    "Community.S04E03.HDTV.x264-LOL.mp4",
+    "Parks.and.Recreation.S05E12.HDTV.x264-LOL.mp4",
+    "The.Office.3x07.avi",
+]
+
+
+def bench_munger(path, size, seconds):
+    def f():
+        for name in NAMES:
+            Munger(name).tv()
+    calls, elapsed = timed(f, seconds)
+    return {"ops_per_s": calls * len(NAMES) / elapsed}
+
+
+def bench_parse(path, size, seconds):
+    calls, elapsed = timed(lambda: parse_many(NAMES), seconds)
+    return {"ops_per_s": calls * len(NAMES) / elapsed}
+
+
+def bench_make_target(path, size, seconds):
+    dest = FilePath("/library")
+    data = {
+        "series": "Series",
+        "eid": 3,
+        "title": "Title",
+        "group": "Group",
+        "fext": "mkv",
+    }
+    formatter = "{series}/{series} - {eid:02d} - {title} - [{group}].{fext}"
+    calls, elapsed = timed(lambda: make_target(dest, data, formatter),
+                           seconds)
+    return {"ops_per_s": calls / elapsed}
+
+
+benchmarks = {
+    "ed2k": bench_ed2k,
+    "ed2k_mmap": bench_ed2k_mmap,
+    "hash_file": bench_hash_file,
+    "checksum": bench_checksum,
+    "derphash": bench_derphash,
+    "munger": bench_munger,
+    "parse": bench_parse,
+    "make_target": bench_make_target,
+}
+
+# Benchmarks which don't read the file, and so only need to run once rather
+# than once per file size.
+sizeless = "checksum", "munger", "parse", "make_target"
+
+
+def _child(queue, name, path, size, seconds):
+    try:
+        result = benchmarks[name](path, size, seconds)
+    except Exception as e:
+        # Don't leave the parent waiting forever.
+        queue.put({"error": repr(e)})
+        raise
+
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_kb"] = peak
+    queue.put(result)
+
+
+def run(name, path, size, seconds):
+    """
+    Run a single benchmark in a fresh process.
+    """
+
+    queue = Queue()
+    child = Process(target=_child, args=(queue, name, path, size, seconds))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+
+def compare(results, baseline):
+    """
+    Print how each result compares to a baseline.
+    """
+
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric, value in sorted(result.items()):
+            old = baseline[key].get(metric)
+            if old:
+                print "%-24s %-12s %12.1f -> %12.1f (%+.1f%%)" % (
+                    key, metric, old, value, (value - old) * 100.0 / old)
+
+
+def argv_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--sizes", help="File sizes to hash, in MiB",
+                        type=float, nargs="+", default=[1, 64])
+    parser.add_argument("--sparse", help="Use sparse files of zeroes",
+                        action="store_true")
+    parser.add_argument("--seconds", help="Time to spend on each benchmark",
+                        type=float, default=2)
+    parser.add_argument("--only", help="Benchmarks to run", nargs="+",
+                        choices=sorted(benchmarks), default=sorted(benchmarks))
+    parser.add_argument("--output", help="Save results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="Compare results to this JSON file")
+    return parser
+
+
+def main():
+    options = argv_parser().parse_args()
+    root = FilePath(mkdtemp())
+    results = {}
+
+    try:
+        for name in options.only:
+            sizes = options.sizes[:1] if name in sizeless else options.sizes
+            for mib in sizes:
+                size = int(mib * MB)
+                path = root.child("%d" % size).path
+                if not os.path.exists(path):
+                    make_file(path, size, options.sparse)
+
+                key = name if name in sizeless else "%s@%gMiB" % (name, mib)
+                result = run(name, path, size, options.seconds)
+                if "error" in result:
+                    print "%-24s failed: %s" % (key, result["error"])
+                    continue
+
+                results[key] = result
+                print "%-24s %s" % (key, ", ".join(
+                    "%s=%.1f" % t for t in sorted(result.items())))
+    finally:
+        root.remove()
+
+    if options.output:
+        with open(options.output, "wb") as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline, "rb") as handle:
+            compare(results, json.load(handle))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,30 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import os
+from tempfile import mkdtemp
 from unittest import TestCase
+import zlib
 
-from pyrite.anidb import pack
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from pyrite.anidb import (MAX_REPLY, AniDBProtocol, SessionExpired,
+                          TokenBucket, Trickling, load_session, pack,
+                          save_session, untag)
+from pyrite.errors import TimedOut, TruncatedReply
+from pyrite.metrics import metrics
+
+
+class FakeTransport(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def write(self, packet):
+        self.sent.append((self.clock.seconds(), packet))
 
 
 class TestPack(TestCase):
@@ -22,3 +43,279 @@ class TestPack(TestCase):
         i = {"key": "value"}
         o = "key=value"
         self.assertEqual(pack(i), o)
+
+
+class TestUntag(TestCase):
+
+    def test_tagged(self):
+        self.assertEqual(untag("T1 300 PONG"), ("T1", "300 PONG"))
+
+    def test_untagged(self):
+        self.assertEqual(untag("555 BANNED"), (None, "555 BANNED"))
+
+
+class TestTokenBucket(TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(0.5, 2, 0)
+        self.assertEqual(bucket.delay(0), 0)
+        bucket.take(0)
+        bucket.take(0)
+        self.assertEqual(bucket.delay(0), 2)
+
+    def test_refill(self):
+        bucket = TokenBucket(0.5, 2, 0)
+        bucket.take(0)
+        bucket.take(0)
+        self.assertEqual(bucket.delay(1), 1)
+        self.assertEqual(bucket.delay(2), 0)
+
+    def test_capacity(self):
+        bucket = TokenBucket(1, 2, 0)
+        bucket.refill(100)
+        self.assertEqual(bucket.tokens, 2)
+
+
+class TestTrickling(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = FakeTransport(self.clock)
+        self.trickling = Trickling(self.clock, self.transport,
+                                   short_rate=0.5, short_burst=2,
+                                   long_rate=0.25, long_burst=3)
+
+    def times(self):
+        return [t for t, packet in self.transport.sent]
+
+    def test_burst_then_limits(self):
+        for i in range(5):
+            self.trickling.write("packet %d" % i)
+        self.clock.pump([1] * 20)
+
+        # Two packets immediately, then one every two seconds until the
+        # long-term bucket runs dry, and then one every four seconds.
+        self.assertEqual(self.times(), [0, 0, 2, 4, 8])
+
+    def test_waited(self):
+        waits = []
+        for i in range(3):
+            self.trickling.write("packet").addCallback(waits.append)
+        self.clock.pump([1] * 5)
+
+        self.assertEqual(waits, [0, 0, 2])
+        self.assertEqual(self.trickling.waited, 2)
+        self.assertEqual(self.trickling.sent, 3)
+
+    def test_backoff(self):
+        self.trickling.write("first")
+        self.trickling.backoff()
+        self.trickling.backoff()
+        self.assertEqual(self.trickling.penalty, 8)
+
+        self.trickling.write("second")
+        self.clock.pump([1] * 10)
+        self.assertEqual(self.times(), [0, 8])
+
+    def test_relax(self):
+        self.trickling.backoff()
+        self.trickling.relax()
+        self.assertEqual(self.trickling.penalty, 0)
+
+
+class TestProtocol(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.wire = FakeTransport(self.clock)
+        self.protocol = AniDBProtocol(self.clock, "127.0.0.1")
+        self.protocol.transport = Trickling(self.clock, self.wire)
+
+    def packets(self):
+        return [packet for t, packet in self.wire.sent]
+
+    def test_tagged(self):
+        d = self.protocol.ping()
+        self.assertEqual(self.packets(), ["PING tag=T1\n"])
+
+        self.protocol.datagramReceived("T1 300 PONG", None)
+        self.assertEqual(self.successResultOf(d), (300, "PONG"))
+
+    def test_out_of_order(self):
+        first = self.protocol.ping()
+        second = self.protocol.ping()
+
+        self.protocol.datagramReceived("T2 300 PONG 2", None)
+        self.protocol.datagramReceived("T1 300 PONG 1", None)
+
+        self.assertEqual(self.successResultOf(first), (300, "PONG 1"))
+        self.assertEqual(self.successResultOf(second), (300, "PONG 2"))
+
+    def test_duplicate(self):
+        first = self.protocol.ping()
+        second = self.protocol.ping()
+
+        self.protocol.datagramReceived("T1 300 PONG 1", None)
+        self.protocol.datagramReceived("T1 300 PONG 1", None)
+
+        self.successResultOf(first)
+        self.assertNoResult(second)
+
+    def test_compressed(self):
+        d = self.protocol.ping()
+        self.protocol.datagramReceived(
+            "\x00\x00" + zlib.compress("T1 300 PONG"), None)
+        self.assertEqual(self.successResultOf(d), (300, "PONG"))
+
+    def test_compressed_raw(self):
+        deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        packet = deflater.compress("T1 300 PONG") + deflater.flush()
+
+        d = self.protocol.ping()
+        self.protocol.datagramReceived("\x00\x00" + packet, None)
+        self.assertEqual(self.successResultOf(d), (300, "PONG"))
+
+    def test_truncated(self):
+        d = self.protocol.ping()
+        packet = "T1 300 PONG " + "x" * MAX_REPLY
+        self.protocol.datagramReceived(packet[:MAX_REPLY], None)
+        self.failureResultOf(d, TruncatedReply)
+
+    def test_truncated_compressed(self):
+        d = self.protocol.ping()
+        packet = zlib.compress("T1 300 PONG " + os.urandom(2 * MAX_REPLY))
+        self.protocol.datagramReceived("\x00\x00" + packet[:MAX_REPLY],
+                                       None)
+        self.failureResultOf(d, TruncatedReply)
+
+    def test_corrupt_compressed(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        d = self.protocol.ping()
+        self.protocol.datagramReceived("\x00\x00\x78garbage", None)
+        self.assertNoResult(d)
+        self.assertEqual(metrics.counters["anidb_dropped_replies"], 1)
+
+    def test_truncated_before_tag(self):
+        d = self.protocol.ping()
+        packet = zlib.compress("T1 300 PONG")
+        for end in 2, 4:
+            self.protocol.datagramReceived("\x00\x00" + packet[:end], None)
+        self.assertNoResult(d)
+
+    def test_truncated_before_code(self):
+        d = self.protocol.ping()
+        packet = zlib.compress("T1 300 PONG")
+        # Inflates to "T1 30".
+        self.protocol.datagramReceived("\x00\x00" + packet[:8], None)
+        self.failureResultOf(d, TruncatedReply)
+
+    def test_lookup_split(self):
+        self.protocol.session = "abcde"
+        d = self.protocol.lookup(1, "hash")
+        self.protocol.datagramReceived("T1 220 FILE\n1|1|hash|mkv|12|12|Ser",
+                                       None)
+
+        first, second = self.packets()[1:]
+        self.assertIn("amask=00000000", first)
+        self.assertIn("fmask=0000000000", second)
+
+        self.protocol.datagramReceived("T2 220 FILE\n1|1|hash|mkv", None)
+        self.protocol.datagramReceived(
+            "T3 220 FILE\n1|12|12|Series|3|Title|Group", None)
+
+        self.assertEqual(self.successResultOf(d), {
+            "fid": 1,
+            "size": 1,
+            "ed2k": "hash",
+            "fext": "mkv",
+            "eid_total": 12,
+            "eid_highest": 12,
+            "series": "Series",
+            "eid": 3,
+            "title": "Title",
+            "group": "Group",
+        })
+
+    def test_retransmit(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+        d = self.protocol.ping()
+        self.clock.advance(self.protocol.timeout)
+        self.assertEqual(self.packets(), ["PING tag=T1\n"] * 2)
+
+        self.clock.advance(0.5)
+        self.protocol.datagramReceived("T1 300 PONG", None)
+        self.successResultOf(d)
+
+        self.assertEqual(metrics.counters["anidb_retransmits"], 1)
+        # Round trips are timed from the latest retransmit.
+        self.assertEqual(metrics.histograms["anidb_rtt_seconds"].sum, 0.5)
+
+    def test_cancel(self):
+        d = self.protocol.ping()
+        d.cancel()
+        self.failureResultOf(d)
+
+        self.clock.pump([1] * 60)
+        self.assertEqual(self.packets(), ["PING tag=T1\n"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_give_up(self):
+        d = self.protocol.ping()
+        self.clock.pump([1] * 600)
+        self.failureResultOf(d, TimedOut)
+        self.assertEqual(len(self.packets()), self.protocol.attempts)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_login(self):
+        d = self.protocol.login("user", "pass")
+        packet = self.packets()[0]
+        self.assertIn("enc=UTF8", packet)
+        self.assertIn("nat=1", packet)
+        self.assertIn("comp=1", packet)
+
+        self.protocol.datagramReceived(
+            "T1 200 abcde 10.0.0.1:1234 LOGIN ACCEPTED", None)
+        self.assertEqual(self.successResultOf(d), "abcde")
+        self.assertEqual(self.protocol.nat, "10.0.0.1:1234")
+
+    def test_session_expired(self):
+        self.protocol.session = "abcde"
+        d = self.protocol.lookup(1, "hash")
+        self.protocol.datagramReceived("T1 506 INVALID SESSION", None)
+        self.failureResultOf(d, SessionExpired)
+
+    def test_keepalive_idle(self):
+        self.protocol.session = "abcde"
+        self.protocol.keepalive(idle=60)
+        self.assertEqual(self.packets(), [])
+
+        self.clock.advance(60)
+        self.protocol.keepalive(idle=60)
+        self.assertEqual(len(self.packets()), 1)
+        self.assertTrue(self.packets()[0].startswith("UPTIME "))
+
+
+class TestSessionFile(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+        self.path = self.root.child("session").path
+
+    def tearDown(self):
+        self.root.remove()
+
+    def test_roundtrip(self):
+        save_session(self.path, "abcde", 1234, 100)
+        saved = load_session(self.path, 200)
+        self.assertEqual(saved["session"], "abcde")
+        self.assertEqual(saved["port"], 1234)
+
+    def test_stale(self):
+        save_session(self.path, "abcde", 1234, 100)
+        self.assertEqual(load_session(self.path, 100 + 30 * 60), None)
+
+    def test_missing(self):
+        self.assertEqual(load_session(self.path, 0), None)
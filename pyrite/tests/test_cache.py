@@ -0,0 +1,134 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from pyrite.cache import HashCache, LookupCache, cached
+
+
+class TestHashCache(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+        self.path = self.root.child("file")
+        self.path.setContent("contents")
+        self.cache = HashCache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+        self.root.remove()
+
+    def test_roundtrip(self):
+        self.cache.put(self.path, {"ed2k": "abc"})
+        self.assertEqual(self.cache.get(self.path), {"ed2k": "abc"})
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get(self.path), {})
+
+    def test_kinds(self):
+        self.cache.put(self.path, {"ed2k": "abc"})
+        self.cache.put(self.path, {"osdb": "def"})
+        self.assertEqual(self.cache.get(self.path),
+                         {"ed2k": "abc", "osdb": "def"})
+
+    def test_invalidate_on_change(self):
+        self.cache.put(self.path, {"ed2k": "abc"})
+        self.path.setContent("different contents")
+        self.assertEqual(self.cache.get(self.path), {})
+
+    def test_prune_deleted(self):
+        self.cache.put(self.path, {"ed2k": "abc"})
+        self.path.remove()
+        self.assertEqual(self.cache.prune(), 1)
+
+    def test_prune_keeps_fresh(self):
+        self.cache.put(self.path, {"ed2k": "abc"})
+        self.assertEqual(self.cache.prune(), 0)
+        self.assertEqual(self.cache.get(self.path), {"ed2k": "abc"})
+
+
+class TestCached(SynchronousTestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+        self.path = self.root.child("file")
+        self.path.setContent("contents")
+        self.cache = HashCache(":memory:")
+        self.calls = []
+
+    def tearDown(self):
+        self.cache.close()
+        self.root.remove()
+
+    def digest(self, filepath):
+        self.calls.append(filepath)
+        return {"ed2k": "digest", "osdb": "other"}
+
+    def test_no_cache(self):
+        cached(None, self.path, "ed2k", self.digest)
+        cached(None, self.path, "ed2k", self.digest)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_computes_once(self):
+        first = cached(self.cache, self.path, "ed2k", self.digest)
+        second = cached(self.cache, self.path, "ed2k", self.digest)
+        self.assertEqual(self.successResultOf(first),
+                         self.successResultOf(second))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_stores_every_kind(self):
+        cached(self.cache, self.path, "ed2k", self.digest)
+        other = cached(self.cache, self.path, "osdb", self.digest)
+        self.assertEqual(self.successResultOf(other), "other")
+        self.assertEqual(len(self.calls), 1)
+
+
+class TestLookupCache(TestCase):
+
+    def setUp(self):
+        self.cache = LookupCache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_miss(self):
+        self.assertEqual(self.cache.get("anidb", 1, "abc"), None)
+
+    def test_roundtrip(self):
+        data = {"title": "Title", "eid": 3}
+        self.cache.put("anidb", 1, "abc", data, 10)
+        self.assertEqual(self.cache.get("anidb", 1, "abc"), (10, data))
+
+    def test_strs(self):
+        self.cache.put("anidb", 1, "abc", {"title": "T\xc3\xaftle"}, 10)
+        stamp, data = self.cache.get("anidb", 1, "abc")
+        self.assertEqual(type(data["title"]), str)
+        self.assertEqual(data["title"], "T\xc3\xaftle")
+
+    def test_negative(self):
+        self.cache.put("anidb", 1, "abc", None, 10)
+        self.assertEqual(self.cache.get("anidb", 1, "abc"), (10, None))
+
+    def test_gurus_separate(self):
+        self.cache.put("anidb", 1, "abc", None, 10)
+        self.assertEqual(self.cache.get("osdb", 1, "abc"), None)
+
+    def test_prune(self):
+        self.cache.put("anidb", 1, "abc", None, 10)
+        self.cache.put("anidb", 2, "def", None, 20)
+        self.assertEqual(self.cache.prune(15), 1)
+        self.assertEqual(self.cache.get("anidb", 1, "abc"), None)
@@ -0,0 +1,112 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from argparse import Namespace
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite.guru import AniDBGuru, OSDBGuru
+from pyrite.metrics import metrics
+from pyrite.main import react_main
+from pyrite.namer import Namer
+from pyrite.tests.benchmark import (UNLIMITED, formatters, make_corpus,
+                                    register)
+from pyrite.tests.fakes import FakeAniDB, FakeOSDB, listen_anidb, listen_osdb
+
+
+class TestEndToEnd(TestCase):
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        self.source = root.child("source")
+        self.dest = root.child("dest")
+        self.paths = make_corpus(self.source, 4, 200 * 1024)
+
+        self.args = Namespace(username="user", password="pass", watch=False,
+                              metrics=None)
+
+    def renamed(self):
+        return sorted(path.basename() for path in self.dest.walk()
+                      if path.isfile())
+
+    @inlineCallbacks
+    def test_anidb(self):
+        server = FakeAniDB(reactor)
+        # Leave the last file unknown.
+        register(self.paths[:-1], anidb=server)
+        port = listen_anidb(reactor, server)
+        self.addCleanup(port.stopListening)
+
+        guru = AniDBGuru(server=("127.0.0.1", port.getHost().port),
+                         limits=UNLIMITED)
+        namer = Namer(guru, formatters["anidb"], dry_run=False)
+
+        yield react_main(reactor, guru, namer, self.source, self.dest,
+                         self.args)
+
+        self.assertEqual(self.renamed(), [
+            "Series - 01 - Episode 1 - [Group].mkv",
+            "Series - 02 - Episode 2 - [Group].mkv",
+            "Series - 03 - Episode 3 - [Group].mkv",
+        ])
+        self.assertTrue(server.received[-1].startswith("LOGOUT "))
+
+    @inlineCallbacks
+    def test_anidb_banned(self):
+        server = FakeAniDB(reactor)
+        register(self.paths, anidb=server)
+        port = listen_anidb(reactor, server)
+        self.addCleanup(port.stopListening)
+
+        guru = AniDBGuru(server=("127.0.0.1", port.getHost().port),
+                         limits=UNLIMITED)
+        yield guru.start(reactor, "user", "pass")
+        self.addCleanup(guru.stop)
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+        server.bans = 1
+        yield self.assertFailure(guru.lookup(self.paths[0]), Exception)
+        # The ban was answered in kind, rather than taken for packet loss.
+        self.assertEqual(metrics.counters["anidb_bans"], 1)
+        self.assertNotIn("anidb_retransmits", metrics.counters)
+
+        transport = guru._p.transport
+        self.assertTrue(transport.penalty)
+        # Don't make logging out wait.
+        transport.relax()
+
+    @inlineCallbacks
+    def test_osdb(self):
+        server = FakeOSDB(reactor)
+        register(self.paths[:-1], osdb=server)
+        port = listen_osdb(reactor, server)
+        self.addCleanup(port.stopListening)
+
+        guru = OSDBGuru(api="http://127.0.0.1:%d/" % port.getHost().port,
+                        batch_window=0.01)
+        namer = Namer(guru, formatters["osdb"], dry_run=False, concurrency=4)
+
+        yield react_main(reactor, guru, namer, self.source, self.dest,
+                         self.args)
+
+        self.assertEqual(self.renamed(), [
+            "Movie 0 (2000).mkv",
+            "Movie 1 (2000).mkv",
+            "Movie 2 (2000).mkv",
+        ])
+        # All four files went out in one batch.
+        self.assertEqual([len(hashes) for hashes in server.searches], [4])
@@ -11,11 +11,78 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import os
 from unittest import TestCase
 
+from twisted.internet.defer import (CancelledError, Deferred, fail,
+                                    inlineCallbacks, succeed)
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.trial.unittest import TestCase as TrialTestCase
+from zope.interface import implements
 from zope.interface.verify import verifyObject
 
-from pyrite.guru import IGuru, AniDBGuru, OSDBGuru
+from pyrite.cache import LookupCache
+from pyrite.errors import FileNotFound, MultipleMatches, TimedOut
+from pyrite.guru import (IGuru, IHashingGuru, AniDBGuru, CachingGuru,
+                         DedupingGuru, FilenameGuru, OSDBGuru, RacingGuru)
+from pyrite.namer import Namer
+
+
+class FakeGuru(object):
+
+    implements(IHashingGuru)
+
+    name = "fake"
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.searches = []
+
+    def start(self, reactor, username, password):
+        return succeed(None)
+
+    def stop(self):
+        return succeed(None)
+
+    def fingerprint(self, filepath):
+        return succeed((len(filepath), filepath))
+
+    def search(self, size, hash):
+        self.searches.append(hash)
+        if hash in self.answers:
+            return succeed(dict(self.answers[hash]))
+        return fail(FileNotFound())
+
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+        d.addCallback(lambda t: self.search(*t))
+        return d
+
+
+class PathGuru(FakeGuru):
+    """
+    A FakeGuru which can be handed FilePaths.
+    """
+
+    def fingerprint(self, filepath):
+        return succeed((0, filepath.basename()))
+
+
+class ContentGuru(FakeGuru):
+    """
+    A FakeGuru which hashes files by their contents.
+    """
+
+    def __init__(self, answers):
+        FakeGuru.__init__(self, answers)
+        self.fingerprints = []
+
+    def fingerprint(self, filepath):
+        self.fingerprints.append(filepath.basename())
+        contents = filepath.getContent()
+        return succeed((len(contents), contents))
 
 
 class TestInterfaces(TestCase):
@@ -25,3 +92,339 @@ class TestInterfaces(TestCase):
 
     def test_verify_osdbguru(self):
         self.assertTrue(verifyObject(IGuru, OSDBGuru()))
+
+    def test_verify_hashing(self):
+        self.assertTrue(verifyObject(IHashingGuru, AniDBGuru()))
+        self.assertTrue(verifyObject(IHashingGuru, OSDBGuru()))
+
+    def test_verify_cachingguru(self):
+        guru = CachingGuru(FakeGuru({}), LookupCache(":memory:"))
+        self.assertTrue(verifyObject(IHashingGuru, guru))
+
+    def test_verify_dedupingguru(self):
+        guru = DedupingGuru(FakeGuru({}))
+        self.assertTrue(verifyObject(IHashingGuru, guru))
+
+    def test_verify_filenameguru(self):
+        self.assertTrue(verifyObject(IGuru, FilenameGuru()))
+
+    def test_verify_racingguru(self):
+        self.assertTrue(verifyObject(IGuru, RacingGuru([])))
+
+
+class TestCachingGuru(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.inner = FakeGuru({"known": {"title": "Title"}})
+        self.guru = CachingGuru(self.inner, LookupCache(":memory:"),
+                                positive_ttl=100, negative_ttl=10)
+        self.guru.start(self.clock, "user", "pass")
+
+    def test_positive(self):
+        first = self.successResultOf(self.guru.lookup("known"))
+        second = self.successResultOf(self.guru.lookup("known"))
+        self.assertEqual(first, {"title": "Title"})
+        self.assertEqual(second, first)
+        self.assertEqual(self.inner.searches, ["known"])
+
+    def test_negative(self):
+        self.failureResultOf(self.guru.lookup("unknown"), FileNotFound)
+        self.failureResultOf(self.guru.lookup("unknown"), FileNotFound)
+        self.assertEqual(self.inner.searches, ["unknown"])
+
+    def test_negative_expires(self):
+        self.failureResultOf(self.guru.lookup("unknown"), FileNotFound)
+        self.clock.advance(11)
+        self.failureResultOf(self.guru.lookup("unknown"), FileNotFound)
+        self.assertEqual(self.inner.searches, ["unknown", "unknown"])
+
+    def test_positive_expires(self):
+        self.successResultOf(self.guru.lookup("known"))
+        self.clock.advance(50)
+        self.successResultOf(self.guru.lookup("known"))
+        self.clock.advance(51)
+        self.successResultOf(self.guru.lookup("known"))
+        self.assertEqual(self.inner.searches, ["known", "known"])
+
+
+class TestFilenameGuru(SynchronousTestCase):
+
+    def setUp(self):
+        self.inner = PathGuru({"movie.mkv": {"title": "Movie"}})
+        self.guru = FilenameGuru(self.inner)
+
+    def test_offline(self):
+        path = FilePath("/tv/Community.S04E03.HDTV.x264-LOL.mp4")
+        data = self.successResultOf(self.guru.lookup(path))
+        self.assertEqual(data, {
+            "series": "Community",
+            "title": "Community",
+            "sid": 4,
+            "eid": 3,
+        })
+        self.assertEqual(self.inner.searches, [])
+
+    def test_fallback(self):
+        data = self.successResultOf(self.guru.lookup(FilePath("movie.mkv")))
+        self.assertEqual(data, {"title": "Movie"})
+        self.assertEqual(self.inner.searches, ["movie.mkv"])
+
+    def test_no_fallback(self):
+        guru = FilenameGuru()
+        self.failureResultOf(guru.lookup(FilePath("movie.mkv")),
+                             FileNotFound)
+
+
+class TestDedupingGuru(SynchronousTestCase):
+
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.inner = ContentGuru({"contents": {"title": "Title"}})
+        self.guru = DedupingGuru(self.inner)
+
+    def test_hardlinks(self):
+        first = self.root.child("first")
+        first.setContent("contents")
+        second = self.root.child("second")
+        first.linkTo(second)
+
+        self.successResultOf(self.guru.lookup(first))
+        self.successResultOf(self.guru.lookup(second))
+        self.assertEqual(self.inner.fingerprints, ["first"])
+
+    def test_copies(self):
+        paths = [self.root.child(name) for name in "first", "second"]
+        for path in paths:
+            path.setContent("contents")
+
+        first, second = [self.successResultOf(self.guru.lookup(path))
+                         for path in paths]
+        self.assertEqual(first, {"title": "Title"})
+        self.assertEqual(second, {"title": "Title", "duplicate": True})
+        self.assertEqual(self.inner.fingerprints, ["first", "second"])
+        self.assertEqual(self.inner.searches, ["contents"])
+
+    def test_same_path(self):
+        path = self.root.child("first")
+        path.setContent("contents")
+
+        self.successResultOf(self.guru.lookup(path))
+        data = self.successResultOf(self.guru.lookup(path))
+        self.assertNotIn("duplicate", data)
+
+    def test_shared_failure(self):
+        path = self.root.child("first")
+        path.setContent("unknown")
+        d = Deferred()
+        self.patch(self.inner, "search", lambda size, hash: d)
+
+        first = self.guru.search(7, "unknown")
+        second = self.guru.search(7, "unknown")
+        d.errback(TimedOut())
+        self.failureResultOf(first, TimedOut)
+        self.failureResultOf(second, TimedOut)
+
+        # Failures which might not happen again aren't remembered.
+        self.patch(self.inner, "search",
+                   lambda size, hash: succeed({"title": "Title"}))
+        self.successResultOf(self.guru.search(7, "unknown"))
+
+    def test_cancel(self):
+        d = Deferred(lambda d: self.inner.searches.append("cancelled"))
+        self.patch(self.inner, "search", lambda size, hash: d)
+
+        first = self.guru.search(8, "contents")
+        second = self.guru.search(8, "contents")
+        first.cancel()
+        self.failureResultOf(first, CancelledError)
+        self.assertNoResult(second)
+        self.assertEqual(self.inner.searches, [])
+
+        # Once nobody is waiting, the search itself is cancelled, and
+        # forgotten.
+        second.cancel()
+        self.failureResultOf(second, CancelledError)
+        self.assertEqual(self.inner.searches, ["cancelled"])
+        self.patch(self.inner, "search",
+                   lambda size, hash: succeed({"title": "Title"}))
+        self.successResultOf(self.guru.search(8, "contents"))
+
+    def test_not_found(self):
+        paths = [self.root.child(name) for name in "first", "second"]
+        for path in paths:
+            path.setContent("unknown")
+
+        for path in paths:
+            self.failureResultOf(self.guru.lookup(path), FileNotFound)
+        self.assertEqual(self.inner.searches, ["unknown"])
+
+    def test_failed_already(self):
+        path = self.root.child("first")
+        path.setContent("unknown")
+
+        self.failureResultOf(self.guru.lookup(path), FileNotFound)
+        self.failureResultOf(self.guru.lookup(path), FileNotFound)
+        self.assertEqual(self.inner.searches, ["unknown"])
+
+        self.patch(self.inner, "fingerprint",
+                   lambda filepath: fail(FileNotFound()))
+        other = self.root.child("other")
+        other.setContent("other")
+        self.failureResultOf(self.guru.lookup(other), FileNotFound)
+
+
+class TestNamerDuplicates(TrialTestCase):
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        self.source = root.child("source")
+        self.source.makedirs()
+        for name in "a.mkv", "b.mkv":
+            self.source.child(name).setContent("contents")
+        self.dest = root.child("dest")
+
+    def rename(self, duplicates):
+        guru = DedupingGuru(ContentGuru({"contents": {"title": "Title"}}))
+        namer = Namer(guru, "{title}.{ext}", dry_run=False,
+                      duplicates=duplicates)
+        return namer.rename(self.source, self.dest)
+
+    @inlineCallbacks
+    def test_skip(self):
+        yield self.rename("skip")
+        self.assertEqual(self.dest.listdir(), ["Title.mkv"])
+        # Either one of them might be found first.
+        self.assertEqual(len(self.source.listdir()), 1)
+
+    @inlineCallbacks
+    def test_number(self):
+        yield self.rename("number")
+        self.assertEqual(sorted(self.dest.listdir()),
+                         ["Title (2).mkv", "Title.mkv"])
+        self.assertEqual(self.source.listdir(), [])
+
+    @inlineCallbacks
+    def test_hardlink(self):
+        yield self.rename("hardlink")
+        target = self.dest.child("Title.mkv")
+        [duplicate] = self.source.children()
+        self.assertEqual(os.stat(target.path).st_ino,
+                         os.stat(duplicate.path).st_ino)
+
+
+class SlowGuru(object):
+    """
+    A guru whose lookups only finish when told to.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lookups = []
+        self.cancelled = []
+
+    def lookup(self, filepath):
+        d = Deferred(self.cancelled.append)
+        self.lookups.append(d)
+        return d
+
+
+class SlowHashingGuru(SlowGuru):
+    """
+    A SlowGuru whose searches only finish when told to.
+    """
+
+    def fingerprint(self, filepath):
+        return succeed((0, filepath.basename()))
+
+    def search(self, size, hash):
+        d = Deferred(self.cancelled.append)
+        self.lookups.append(d)
+        return d
+
+    def lookup(self, filepath):
+        d = self.fingerprint(filepath)
+        d.addCallback(lambda t: self.search(*t))
+        return d
+
+
+class TestRacingGuru(SynchronousTestCase):
+
+    def setUp(self):
+        self.first = SlowGuru("first")
+        self.second = SlowGuru("second")
+
+    def test_race(self):
+        guru = RacingGuru([self.first, self.second])
+        d = guru.lookup("file")
+        self.assertEqual(len(self.first.lookups), 1)
+        self.assertEqual(len(self.second.lookups), 1)
+
+        self.second.lookups[0].callback({"title": "Title"})
+        self.assertEqual(self.successResultOf(d),
+                         {"title": "Title", "guru": "second"})
+        self.assertEqual(self.first.cancelled, self.first.lookups)
+        self.assertEqual(self.second.cancelled, [])
+
+    def test_race_deduped(self):
+        path = FilePath(self.mktemp())
+        path.setContent("contents")
+        first = SlowHashingGuru("first")
+        second = SlowHashingGuru("second")
+        guru = RacingGuru([DedupingGuru(first), DedupingGuru(second)])
+
+        d = guru.lookup(path)
+        second.lookups[0].callback({"title": "Title"})
+        self.successResultOf(d)
+        # The cancellation went through to the losing search.
+        self.assertEqual(first.cancelled, first.lookups)
+
+    def test_race_loser_fails_first(self):
+        guru = RacingGuru([self.first, self.second])
+        d = guru.lookup("file")
+
+        self.first.lookups[0].errback(FileNotFound())
+        self.assertNoResult(d)
+        self.second.lookups[0].callback({"title": "Title"})
+        self.assertEqual(self.successResultOf(d)["guru"], "second")
+
+    def test_race_nobody_knows(self):
+        guru = RacingGuru([self.first, self.second])
+        d = guru.lookup("file")
+
+        self.first.lookups[0].errback(FileNotFound())
+        self.second.lookups[0].errback(MultipleMatches())
+        self.failureResultOf(d, MultipleMatches)
+
+    def test_race_immediate(self):
+        offline = FilenameGuru()
+        guru = RacingGuru([offline, self.first])
+
+        d = guru.lookup(FilePath("The.Office.3x07.avi"))
+        self.assertEqual(self.successResultOf(d)["guru"], "filename")
+        # Nobody else needed asking.
+        self.assertEqual(self.first.lookups, [])
+
+    def test_ordered(self):
+        guru = RacingGuru([self.first, self.second], ordered=True)
+        d = guru.lookup("file")
+        self.assertEqual(len(self.second.lookups), 0)
+
+        self.first.lookups[0].errback(FileNotFound())
+        self.assertEqual(len(self.second.lookups), 1)
+
+        self.second.lookups[0].callback({"title": "Title"})
+        self.assertEqual(self.successResultOf(d)["guru"], "second")
+
+    def test_ordered_nobody_knows(self):
+        guru = RacingGuru([self.first, self.second], ordered=True)
+        d = guru.lookup("file")
+
+        self.first.lookups[0].errback(FileNotFound())
+        self.second.lookups[0].errback(FileNotFound())
+        self.failureResultOf(d, FileNotFound)
+
+    def test_formatters(self):
+        namer = Namer(None, {"first": "{title}", "second": "{eid}"})
+        self.assertEqual(namer.formatter({"guru": "second"}), "{eid}")
@@ -0,0 +1,122 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from hashlib import md5, sha1
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase
+from zlib import crc32
+
+from Crypto.Hash import MD4
+from twisted.python.filepath import FilePath
+
+from pyrite.hashing import CHUNK, MultiHasher, digests, ed2k, hash_file
+from pyrite.osdb import derphash
+
+
+def pattern(size):
+    return ("0123456789abcdef" * (size // 16 + 1))[:size]
+
+
+def reference_ed2k(handle):
+    """
+    The original, straightforward ED2K, which allocates a string per leaf.
+    """
+
+    hashl = []
+    while True:
+        buf = handle.read(CHUNK)
+        if buf == '':
+            break
+        hashl.append(MD4.new(buf).digest())
+    return MD4.new(''.join(hashl)).hexdigest()
+
+
+class TestED2K(TestCase):
+
+    sizes = 0, 1, 1000, CHUNK - 1, CHUNK, CHUNK + 1, CHUNK * 2
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+
+    def tearDown(self):
+        self.root.remove()
+
+    def test_readinto(self):
+        for size in self.sizes:
+            path = self.root.child(str(size))
+            path.setContent(pattern(size))
+            with path.open("rb") as handle:
+                expected = reference_ed2k(handle)
+            with path.open("rb") as handle:
+                self.assertEqual(ed2k(handle), expected)
+
+    def test_mmap(self):
+        for size in self.sizes:
+            path = self.root.child(str(size))
+            path.setContent(pattern(size))
+            with path.open("rb") as handle:
+                expected = reference_ed2k(handle)
+            with path.open("rb") as handle:
+                self.assertEqual(ed2k(handle, use_mmap=True), expected)
+
+    def test_stringio(self):
+        data = pattern(CHUNK + 1)
+        self.assertEqual(ed2k(StringIO(data)),
+                         reference_ed2k(StringIO(data)))
+
+    def test_hash_file_mmap(self):
+        path = self.root.child("file")
+        path.setContent(pattern(CHUNK + 70000))
+        self.assertEqual(hash_file(path, use_mmap=True), hash_file(path))
+
+
+class TestDigests(TestCase):
+
+    def check(self, data):
+        d = digests(StringIO(data))
+
+        self.assertEqual(d["ed2k"], ed2k(StringIO(data)))
+        self.assertEqual(d["md5"], md5(data).hexdigest())
+        self.assertEqual(d["sha1"], sha1(data).hexdigest())
+        self.assertEqual(d["crc32"], "%08x" % (crc32(data) & 0xffffffff))
+
+        return d
+
+    def test_empty(self):
+        d = self.check("")
+        self.assertNotIn("osdb", d)
+
+    def test_small(self):
+        d = self.check(pattern(1000))
+        self.assertNotIn("osdb", d)
+
+    def test_osdb(self):
+        data = pattern(200 * 1024)
+        d = self.check(data)
+        self.assertEqual(d["osdb"], derphash(StringIO(data)))
+
+    def test_exact_chunk(self):
+        self.check(pattern(CHUNK))
+
+    def test_several_chunks(self):
+        data = pattern(CHUNK * 2 + 1234)
+        d = self.check(data)
+        self.assertEqual(d["osdb"], derphash(StringIO(data)))
+
+    def test_uneven_updates(self):
+        data = pattern(CHUNK + 70000)
+        hasher = MultiHasher()
+        for i in range(0, len(data), 1000003):
+            hasher.update(data[i:i + 1000003])
+        self.assertEqual(hasher.digests(), digests(StringIO(data)))
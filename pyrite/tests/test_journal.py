@@ -0,0 +1,156 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite.journal import Journal, read, undo
+from pyrite.namer import Namer
+from pyrite.tests.fakes import CountingGuru
+
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_round_trip(self):
+        journal = Journal(self.path)
+        journal.record("found", FilePath("/a/\xff"), data={"title": "T"})
+        journal.record("moved", FilePath("/a/\xff"), target=FilePath("/b"),
+                       placement="move")
+        journal.close()
+
+        entries = list(read(self.path))
+        self.assertEqual([e["event"] for e in entries], ["found", "moved"])
+        self.assertEqual(entries[0]["path"], "/a/\xff")
+        self.assertEqual(entries[0]["data"], {"title": "T"})
+        self.assertEqual(entries[1]["target"], "/b")
+
+    def test_torn(self):
+        journal = Journal(self.path)
+        journal.record("planned", FilePath("/a"))
+        journal.close()
+        with open(self.path, "ab") as handle:
+            handle.write('{"event": "fou')
+
+        self.assertEqual(len(list(read(self.path))), 1)
+
+    def test_previous(self):
+        journal = Journal(self.path)
+        journal.record("planned", FilePath("/a"))
+        journal.record("skipped", FilePath("/a"), result="notfound")
+        journal.close()
+
+        journal = Journal(self.path, resume=True)
+        self.assertEqual(journal.previous(FilePath("/a"))["result"],
+                         "notfound")
+        self.assertEqual(journal.previous(FilePath("/b")), None)
+
+        fresh = Journal(self.path)
+        self.assertEqual(fresh.previous(FilePath("/a")), None)
+
+
+class TestNamerJournal(TestCase):
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        self.source = root.child("source")
+        self.source.makedirs()
+        self.dest = root.child("dest")
+        self.path = root.child("journal").path
+        self.guru = CountingGuru()
+
+    def namer(self, resume=False):
+        return Namer(self.guru, "{title}.{ext}", dry_run=False,
+                     journal=Journal(self.path, resume=resume))
+
+    @inlineCallbacks
+    def test_resume_found(self):
+        a = self.source.child("a.mkv")
+        a.setContent("a")
+        # A run which looked a file up but died before moving it.
+        journal = Journal(self.path)
+        journal.record("found", a, data={"title": "Remembered"})
+        journal.close()
+
+        yield self.namer(resume=True).rename(self.source, self.dest)
+
+        self.assertEqual(self.guru.lookups, [])
+        self.assertTrue(self.dest.child("Remembered.mkv").exists())
+
+    @inlineCallbacks
+    def test_resume_skipped(self):
+        a = self.source.child("a.mkv")
+        a.setContent("a")
+        journal = Journal(self.path)
+        journal.record("skipped", a, result="notfound")
+        journal.close()
+
+        yield self.namer(resume=True).rename(self.source, self.dest)
+        self.assertEqual(self.guru.lookups, [])
+
+        yield self.namer().rename(self.source, self.dest)
+        self.assertEqual(self.guru.lookups, [a])
+
+    @inlineCallbacks
+    def test_undo(self):
+        self.source.child("a.mkv").setContent("a")
+        self.source.child("b.mkv").setContent("b")
+
+        yield self.namer().rename(self.source, self.dest)
+        self.assertEqual(sorted(self.dest.listdir()),
+                         ["Title a.mkv", "Title b.mkv"])
+        self.assertEqual([e["event"] for e in read(self.path)],
+                         ["planned", "found", "moved"] * 2)
+
+        self.assertEqual(undo(self.path), 2)
+        self.assertEqual(self.dest.listdir(), [])
+        self.assertEqual(self.source.child("a.mkv").getContent(), "a")
+        self.assertEqual(self.source.child("b.mkv").getContent(), "b")
+
+        # Undoing twice does nothing.
+        self.assertEqual(undo(self.path), 0)
+
+    @inlineCallbacks
+    def test_undo_again(self):
+        source = self.source.child("a.mkv")
+        source.setContent("a")
+
+        yield self.namer().rename(self.source, self.dest)
+        self.assertEqual(undo(self.path), 1)
+
+        # The same file, moved to the same place by a later run, can be
+        # undone again.
+        yield self.namer().rename(self.source, self.dest)
+        self.assertEqual(self.dest.listdir(), ["Title a.mkv"])
+        self.assertEqual(undo(self.path), 1)
+        self.assertEqual(self.dest.listdir(), [])
+        self.assertEqual(source.getContent(), "a")
+
+    def test_undo_kept(self):
+        source = self.source.child("a.mkv")
+        source.setContent("a")
+        target = self.source.child("b.mkv")
+        os.link(source.path, target.path)
+
+        journal = Journal(self.path)
+        journal.record("moved", source, target=target, placement="hardlink")
+        journal.close()
+
+        self.assertEqual(undo(self.path), 1)
+        self.assertFalse(target.exists())
+        self.assertEqual(source.getContent(), "a")
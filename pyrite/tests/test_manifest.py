@@ -0,0 +1,104 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite.manifest import Manifest
+from pyrite.namer import Namer
+from pyrite.tests.fakes import CountingGuru
+from pyrite.transfer import Mover
+
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.makedirs()
+        self.path = self.root.child("file")
+        self.path.setContent("contents")
+        self.manifest = Manifest(":memory:")
+
+    def test_unknown(self):
+        self.assertFalse(self.manifest.done(self.path))
+
+    def test_done(self):
+        self.manifest.record(self.path, "named", self.path)
+        self.assertTrue(self.manifest.done(self.path))
+
+    def test_elsewhere(self):
+        self.manifest.record(self.path, "skipped", self.root.child("other"))
+        self.assertFalse(self.manifest.done(self.path))
+
+    def test_kept(self):
+        target = self.root.child("other")
+        self.manifest.record(self.path, "kept", target)
+        self.assertFalse(self.manifest.done(self.path))
+        target.setContent("contents")
+        self.assertTrue(self.manifest.done(self.path))
+
+    def test_changed(self):
+        self.manifest.record(self.path, "named", self.path)
+        self.path.setContent("other contents")
+        self.assertFalse(self.manifest.done(self.path))
+
+    def test_get(self):
+        self.manifest.record(self.path, "notfound")
+        identity, result, target = self.manifest.get(self.path)
+        self.assertEqual(result, "notfound")
+        self.assertEqual(target, None)
+
+
+class TestNamerManifest(TestCase):
+
+    @inlineCallbacks
+    def test_second_run_skips(self):
+        root = FilePath(self.mktemp())
+        source = root.child("source")
+        source.makedirs()
+        source.child("file.mkv").setContent("contents")
+        dest = root.child("dest")
+
+        guru = CountingGuru()
+        namer = Namer(guru, "{title}.{ext}", dry_run=False,
+                      manifest=Manifest(":memory:"))
+
+        yield namer.rename(source, dest)
+        self.assertTrue(dest.child("Title f.mkv").exists())
+
+        # Renaming the library in place finds nothing new to do.
+        yield namer.rename(dest, dest)
+        self.assertEqual(len(guru.lookups), 1)
+
+    @inlineCallbacks
+    def test_second_run_skips_kept(self):
+        root = FilePath(self.mktemp())
+        source = root.child("source")
+        source.makedirs()
+        source.child("file.mkv").setContent("contents")
+        dest = root.child("dest")
+
+        guru = CountingGuru()
+        mover = Mover(reactor, placement="hardlink")
+        namer = Namer(guru, "{title}.{ext}", dry_run=False,
+                      manifest=Manifest(":memory:"), mover=mover)
+
+        yield namer.rename(source, dest)
+        self.assertTrue(dest.child("Title f.mkv").exists())
+        self.assertTrue(source.child("file.mkv").exists())
+
+        # The original was kept, but it's been dealt with all the same.
+        yield namer.rename(source, dest)
+        self.assertEqual(len(guru.lookups), 1)
@@ -0,0 +1,90 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import json
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite.cache import HashCache, cached
+from pyrite.metrics import Histogram, Metrics, metrics
+
+
+class TestHistogram(TestCase):
+
+    def test_cumulative(self):
+        h = Histogram(buckets=(1, 10))
+        for value in 0.5, 1, 5, 20:
+            h.observe(value)
+
+        self.assertEqual(h.cumulative(),
+                         [(1, 2), (10, 3), (float("inf"), 4)])
+        self.assertEqual(h.count, 4)
+        self.assertEqual(h.sum, 26.5)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.count("files")
+        self.metrics.count("files", 2)
+        self.metrics.observe("rtt_seconds", 0.2)
+
+    def test_count(self):
+        self.assertEqual(self.metrics.counters, {"files": 3})
+
+    def test_prometheus(self):
+        lines = self.metrics.as_prometheus().splitlines()
+        self.assertIn("# TYPE pyrite_files counter", lines)
+        self.assertIn("pyrite_files 3", lines)
+        self.assertIn("# TYPE pyrite_rtt_seconds histogram", lines)
+        self.assertIn('pyrite_rtt_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('pyrite_rtt_seconds_bucket{le="0.5"} 1', lines)
+        self.assertIn('pyrite_rtt_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn("pyrite_rtt_seconds_count 1", lines)
+
+    def test_dump_json(self):
+        path = self.mktemp() + ".json"
+        self.metrics.dump(path)
+
+        with open(path, "rb") as handle:
+            data = json.load(handle)
+        self.assertEqual(data["counters"], {"files": 3})
+        self.assertEqual(data["histograms"]["rtt_seconds"]["count"], 1)
+
+    def test_dump_prometheus(self):
+        path = self.mktemp() + ".prom"
+        self.metrics.dump(path)
+
+        with open(path, "rb") as handle:
+            self.assertEqual(handle.read(), self.metrics.as_prometheus())
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+    def test_hash_cache(self):
+        path = FilePath(self.mktemp())
+        path.setContent("contents")
+        cache = HashCache(":memory:")
+
+        f = lambda fp: {"ed2k": "hash"}
+        cached(cache, path, "ed2k", f)
+        cached(cache, path, "ed2k", f)
+
+        self.assertEqual(metrics.counters["hash_cache_misses"], 1)
+        self.assertEqual(metrics.counters["hash_cache_hits"], 1)
@@ -13,7 +13,7 @@
 # under the License.
 from unittest import TestCase
 
-from pyrite.munger import Munger
+from pyrite.munger import Munger, fast, parse, parse_many
 
 
 class TestTV(TestCase):
@@ -33,3 +33,36 @@ class TestTV(TestCase):
         self.assertEqual(name, "Parks and Recreation")
         self.assertEqual(ep, (5, 12))
         self.assertEqual(ext, "mp4")
+
+
+class TestParse(TestCase):
+
+    names = [
+        "Community.S04E03.HDTV.x264-LOL.mp4",
+        "Parks.and.Recreation.S05E12.HDTV.x264-LOL.mp4",
+        "The.Office.3x07.avi",
+        "Show.S01E02.HDTV",
+        "Show.S01E02.HDTV.HDTV",
+        "Show.S01E02.x264-A-B.mkv",
+        "Show.S01E02.m.4v",
+    ]
+
+    def test_agrees_with_grammar(self):
+        for name in self.names:
+            self.assertEqual(parse(name), Munger(name).tv())
+
+    def test_fast(self):
+        self.assertTrue(fast.match("The.Office.3x07.avi"))
+
+    def test_fallback(self):
+        # Dotted extensions are left to the grammar.
+        name = "Show.S01E02.m.4v"
+        self.assertFalse(fast.match(name))
+        self.assertEqual(parse(name), ("Show", (1, 2), "m.4v"))
+
+    def test_unparseable(self):
+        self.assertEqual(parse("Show.Name.S01E02.720p.mkv"), None)
+
+    def test_parse_many(self):
+        self.assertEqual(parse_many(["The.Office.3x07.avi", "movie.mkv"]),
+                         [("The Office", (3, 7), "avi"), None])
@@ -0,0 +1,85 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock, Cooperator
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from pyrite import namer
+from pyrite.errors import TimedOut
+from pyrite.namer import Namer
+
+
+class StuckGuru(object):
+    """
+    A guru which fails to look up one file, and never finishes the rest.
+    """
+
+    def __init__(self, broken):
+        self.broken = broken
+        self.pending = []
+
+    def lookup(self, filepath):
+        if filepath.basename() == self.broken:
+            return fail(RuntimeError("broken"))
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+
+class TestRename(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        cooperator = Cooperator(
+            scheduler=lambda f: self.clock.callLater(0, f))
+        self.patch(namer, "cooperate", cooperator.cooperate)
+
+        root = FilePath(self.mktemp())
+        self.source = root.child("source")
+        self.source.makedirs()
+        for name in "a.mkv", "b.mkv":
+            self.source.child(name).setContent(name)
+        self.dest = root.child("dest")
+
+    def test_failure_waits(self):
+        guru = StuckGuru("a.mkv")
+        d = Namer(guru, "{title}.{ext}", concurrency=2).rename(self.source,
+                                                               self.dest)
+        for i in range(5):
+            self.clock.advance(0)
+
+        # The other file is still being looked up.
+        self.assertEqual(len(guru.pending), 1)
+        self.assertNoResult(d)
+
+        guru.pending[0].errback(RuntimeError("also broken"))
+        for i in range(5):
+            self.clock.advance(0)
+        self.failureResultOf(d, RuntimeError)
+
+    def test_timed_out(self):
+        guru = StuckGuru(None)
+        d = Namer(guru, "{title}.{ext}", concurrency=2).rename(self.source,
+                                                               self.dest)
+        for i in range(5):
+            self.clock.advance(0)
+        for pending in guru.pending:
+            pending.errback(TimedOut())
+        for i in range(5):
+            self.clock.advance(0)
+
+        # Files which time out are left for another run.
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(len(self.source.listdir()), 2)
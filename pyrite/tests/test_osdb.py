@@ -0,0 +1,152 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from random import Random
+from StringIO import StringIO
+from struct import Struct
+from unittest import TestCase
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from pyrite import osdb
+from pyrite.errors import FileNotFound
+from pyrite.osdb import Batcher, checksum, checksums, derphash, derphashes
+
+
+def reference_checksum(data):
+    """
+    The original word-at-a-time checksum.
+    """
+
+    s = Struct("<Q")
+    i = 0
+    for offset in range(0, len(data), s.size):
+        i += s.unpack_from(data, offset=offset)[0]
+        i %= 2 ** 64
+    return i
+
+
+def noise(size, seed):
+    r = Random(seed)
+    return "".join(chr(r.getrandbits(8)) for i in xrange(size))
+
+
+class TestChecksum(TestCase):
+
+    def setUp(self):
+        self.blocks = [noise(64 * 1024, seed) for seed in range(3)]
+        self.blocks.append("\xff" * 64 * 1024)
+
+    def test_checksum(self):
+        for block in self.blocks:
+            self.assertEqual(checksum(block), reference_checksum(block))
+
+    def test_checksums(self):
+        self.assertEqual(checksums(self.blocks),
+                         [reference_checksum(b) for b in self.blocks])
+
+    def test_checksums_empty(self):
+        self.assertEqual(checksums([]), [])
+
+    def test_checksums_uneven(self):
+        blocks = ["\x01" * 8, "\x02" * 16]
+        self.assertEqual(checksums(blocks),
+                         [reference_checksum(b) for b in blocks])
+
+    def test_without_numpy(self):
+        saved, osdb.numpy = osdb.numpy, None
+        try:
+            self.assertEqual(checksums(self.blocks),
+                             [reference_checksum(b) for b in self.blocks])
+        finally:
+            osdb.numpy = saved
+
+
+class TestDerphash(TestCase):
+
+    def test_known(self):
+        # 128 KiB of zeroes hashes to just its size.
+        self.assertEqual(derphash(StringIO("\x00" * 128 * 1024)),
+                         "%016x" % (128 * 1024))
+
+    def test_batch(self):
+        datas = [noise(100 * 1024, seed) for seed in range(3)]
+        single = [derphash(StringIO(data)) for data in datas]
+        batch = derphashes(StringIO(data) for data in datas)
+        self.assertEqual(batch, single)
+
+
+class FakeOSDB(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def search_many(self, derps):
+        d = Deferred()
+        self.calls.append((sorted(derps), d))
+        return d
+
+
+class TestBatcher(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.db = FakeOSDB()
+        self.batcher = Batcher(self.clock, self.db, window=1, limit=3)
+
+    def test_window(self):
+        first = self.batcher.search("a")
+        second = self.batcher.search("b")
+        self.assertEqual(self.db.calls, [])
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.db.calls), 1)
+        derps, d = self.db.calls[0]
+        self.assertEqual(derps, ["a", "b"])
+
+        d.callback({"a": [{"MovieName": "A"}]})
+        self.assertEqual(self.successResultOf(first), [{"MovieName": "A"}])
+        self.failureResultOf(second, FileNotFound)
+
+    def test_limit(self):
+        for derp in "abc":
+            self.batcher.search(derp)
+        self.assertEqual(len(self.db.calls), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_duplicates(self):
+        first = self.batcher.search("a")
+        second = self.batcher.search("a")
+        self.batcher.flush()
+        derps, d = self.db.calls[0]
+        self.assertEqual(derps, ["a"])
+
+        d.callback({"a": [{"MovieName": "A"}]})
+        self.assertEqual(self.successResultOf(first),
+                         self.successResultOf(second))
+
+    def test_error(self):
+        first = self.batcher.search("a")
+        second = self.batcher.search("b")
+        self.batcher.flush()
+        derps, d = self.db.calls[0]
+
+        d.errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+
+    def test_empty_flush(self):
+        self.batcher.flush()
+        self.assertEqual(self.db.calls, [])
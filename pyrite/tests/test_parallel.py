@@ -0,0 +1,84 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+
+from pyrite.hashing import CHUNK, hash_file, size_and_hash
+from pyrite.parallel import ProcessHasher, ThreadedHasher
+
+
+class TestProcessHasher(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(mkdtemp())
+        self.hasher = ProcessHasher(2)
+
+    def tearDown(self):
+        self.hasher.close()
+        self.root.remove()
+
+    def make(self, name, size):
+        path = self.root.child(name)
+        path.setContent(("%d" % size) * (size // len("%d" % size)))
+        return path
+
+    def test_ed2k_matches(self):
+        for size in (0, 100, CHUNK, CHUNK * 2 + 17):
+            path = self.make("file%d" % size, size)
+            self.assertEqual(self.hasher.ed2k(path), size_and_hash(path)[1])
+
+    def test_hash_files(self):
+        paths = [self.make("file%d" % i, 1000 * i) for i in range(1, 5)]
+        results = dict(self.hasher.hash_files(paths))
+        self.assertEqual(sorted(results), sorted(paths))
+        for path in paths:
+            self.assertEqual(results[path], hash_file(path))
+
+
+class TestThreadedHasher(unittest.TestCase):
+
+    def test_result(self):
+        hasher = ThreadedHasher(reactor)
+        d = hasher.run(lambda x: x * 2, 21)
+        d.addCallback(self.assertEqual, 42)
+        return d
+
+    def test_limit(self):
+        hasher = ThreadedHasher(reactor, 2)
+        lock = Lock()
+        counts = {"current": 0, "highest": 0}
+
+        def work():
+            with lock:
+                counts["current"] += 1
+                counts["highest"] = max(counts["highest"], counts["current"])
+            sleep(0.01)
+            with lock:
+                counts["current"] -= 1
+
+        d = gatherResults([hasher.run(work) for i in range(8)])
+        self.assertTrue(hasher.waiting > 0)
+
+        @d.addCallback
+        def cb(chaff):
+            self.assertTrue(counts["highest"] <= 2)
+
+        return d
@@ -0,0 +1,68 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import pstats
+import select
+from StringIO import StringIO
+import sys
+
+from twisted.trial.unittest import TestCase
+
+from pyrite.profiling import profiled, split_idle
+
+
+def wait():
+    select.select([], [], [], 0.05)
+
+
+def busy():
+    sum(xrange(10000))
+
+
+def run():
+    wait()
+    busy()
+
+
+class TestProfiled(TestCase):
+
+    def setUp(self):
+        self.output = StringIO()
+        self.patch(sys, "stdout", self.output)
+        self.path = self.mktemp()
+
+    def test_stats(self):
+        profiled(self.path, run)
+
+        names = [name for filename, line, name
+                 in pstats.Stats(self.path).stats]
+        self.assertIn("busy", names)
+        self.assertIn("Reactor idle:", self.output.getvalue())
+
+    def test_exit(self):
+        def exit():
+            raise SystemExit(0)
+
+        self.assertRaises(SystemExit, profiled, self.path, exit)
+        self.assertIn("Wall time", self.output.getvalue())
+
+    def test_split_idle(self):
+        profiled(self.path, run)
+        stats = pstats.Stats(self.path)
+        total = stats.total_tt
+
+        idle = split_idle(stats)
+        self.assertTrue(idle >= 0.05)
+        self.assertEqual(stats.total_tt, total - idle)
+        self.assertNotIn("<select.select>",
+                         [name for filename, line, name in stats.stats])
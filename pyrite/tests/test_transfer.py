@@ -0,0 +1,226 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import errno
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite.cache import HashCache
+from pyrite.errors import VerificationFailed
+from pyrite import transfer
+from pyrite.hashing import hash_file
+from pyrite.transfer import (Mover, copy, copy_fds, hardlink, methods,
+                             move_file, place_file, reflink, symlink)
+
+
+class TestCopyFDs(TestCase):
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        self.data = os.urandom(300 * 1024)
+        self.source = root.child("source")
+        self.source.setContent(self.data)
+        self.target = root.child("target")
+
+    def copy(self, **kwargs):
+        with self.source.open("rb") as src:
+            with self.target.open("wb") as dst:
+                return copy_fds(src.fileno(), dst.fileno(), len(self.data),
+                                chunk=100 * 1024, **kwargs)
+
+    def test_methods(self):
+        for method in methods:
+            self.assertEqual(self.copy(methods=[method]), len(self.data))
+            self.assertEqual(self.target.getContent(), self.data)
+
+    def test_userspace(self):
+        self.assertEqual(self.copy(methods=[]), len(self.data))
+        self.assertEqual(self.target.getContent(), self.data)
+
+    def test_unsupported(self):
+        def broken(src, dst, count):
+            raise OSError(errno.ENOSYS, "Function not implemented")
+
+        self.assertEqual(self.copy(methods=[broken]), len(self.data))
+        self.assertEqual(self.target.getContent(), self.data)
+
+    def test_short(self):
+        self.source.setContent(self.data[:1000])
+        self.assertEqual(self.copy(), 1000)
+
+
+class CrossDeviceMixin(object):
+    """
+    Pretend that the source and destination directories are on different
+    filesystems.
+    """
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        self.source = root.child("source").child("file.mkv")
+        self.source.parent().makedirs()
+        self.data = os.urandom(200 * 1024)
+        self.source.setContent(self.data)
+        self.target = root.child("dest").child("file.mkv")
+        self.target.parent().makedirs()
+
+        self.rename = rename = os.rename
+
+        def cross(src, dst):
+            if src == self.source.path:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(src, dst)
+
+        self.patch(os, "rename", cross)
+
+    def leftovers(self):
+        return [child.basename() for child in self.target.parent().children()
+                if child != self.target]
+
+
+class TestMoveFile(CrossDeviceMixin, TestCase):
+
+    def test_same_device(self):
+        self.patch(os, "rename", self.rename)
+        self.assertFalse(move_file(self.source, self.target))
+        self.assertEqual(self.target.getContent(), self.data)
+
+    def test_cross_device(self):
+        self.assertTrue(move_file(self.source, self.target))
+        self.assertFalse(self.source.exists())
+        self.assertEqual(self.target.getContent(), self.data)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_cross_device_synced(self):
+        synced = []
+
+        def sync(path):
+            # The source is only removed once the target is on disk.
+            self.assertTrue(os.path.exists(self.source.path))
+            synced.append(path)
+
+        self.patch(transfer, "_sync_directory", sync)
+        self.assertTrue(move_file(self.source, self.target))
+        self.assertEqual(synced, [self.target.dirname()])
+        self.assertFalse(os.path.exists(self.source.path))
+
+    def test_verify(self):
+        self.assertTrue(move_file(self.source, self.target, verify=True))
+        self.assertEqual(self.target.getContent(), self.data)
+
+    def test_verify_expected(self):
+        expected = hash_file(self.source)
+        self.assertTrue(move_file(self.source, self.target, True, expected))
+        self.assertEqual(self.target.getContent(), self.data)
+
+    def test_verify_partial(self):
+        def corrupting(src, dst, size, *args):
+            copied = copy_fds(src, dst, size, *args)
+            os.lseek(dst, size // 2, os.SEEK_SET)
+            os.write(dst, chr(ord(self.data[size // 2]) ^ 0xff))
+            return copied
+
+        self.patch(transfer, "copy_fds", corrupting)
+        # The OSDB hash misses the middle of the file, so it isn't trusted
+        # on its own.
+        expected = {"osdb": hash_file(self.source)["osdb"]}
+        self.assertRaises(VerificationFailed, move_file, self.source,
+                          self.target, True, expected)
+        self.assertEqual(self.source.getContent(), self.data)
+
+    def test_verify_mismatch(self):
+        expected = {"ed2k": "0" * 32}
+        self.assertRaises(VerificationFailed, move_file, self.source,
+                          self.target, True, expected)
+        # Nothing is lost, and nothing is left half-done.
+        self.assertEqual(self.source.getContent(), self.data)
+        self.assertFalse(self.target.exists())
+        self.assertEqual(self.leftovers(), [])
+
+    def test_keeps_mode(self):
+        self.source.chmod(0640)
+        move_file(self.source, self.target)
+        self.assertEqual(self.target.getPermissions().shorthand(),
+                         "rw-r-----")
+
+
+class TestPlaceFile(TestCase):
+
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        self.data = os.urandom(100 * 1024)
+        self.source = root.child("source")
+        self.source.setContent(self.data)
+        self.target = root.child("target")
+
+    def place(self, placement):
+        strategy = place_file(self.source, self.target, placement)
+        self.assertEqual(self.target.getContent(), self.data)
+        self.assertEqual(self.source.getContent(), self.data)
+        self.assertEqual(sorted(self.target.parent().listdir()),
+                         ["source", "target"])
+        return strategy
+
+    def test_hardlink(self):
+        self.assertIs(self.place("hardlink"), hardlink)
+        self.assertEqual(os.stat(self.source.path).st_ino,
+                         os.stat(self.target.path).st_ino)
+
+    def test_symlink(self):
+        self.assertIs(self.place("symlink"), symlink)
+        self.assertEqual(os.readlink(self.target.path), self.source.path)
+
+    def test_reflink(self):
+        # Not every filesystem can reflink; those which can't get copies.
+        self.assertIn(self.place("reflink"), (reflink, copy))
+
+    def test_copy(self):
+        self.assertIs(self.place("copy"), copy)
+        self.assertNotEqual(os.stat(self.source.path).st_ino,
+                            os.stat(self.target.path).st_ino)
+
+    def test_hardlink_fallback(self):
+        def link(src, dst):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        self.patch(os, "link", link)
+        self.assertIn(self.place("hardlink"), (reflink, copy))
+
+    def test_replace(self):
+        self.target.setContent("old")
+        self.place("hardlink")
+
+
+class TestMover(CrossDeviceMixin, TestCase):
+
+    @inlineCallbacks
+    def test_move(self):
+        mover = Mover(reactor)
+        yield mover.move(self.source, self.target)
+        self.assertEqual(self.target.getContent(), self.data)
+
+    @inlineCallbacks
+    def test_verify_cached(self):
+        cache = HashCache(":memory:")
+        cache.put(self.source, {"ed2k": "0" * 32})
+        mover = Mover(reactor, cache=cache, verify=True)
+
+        yield self.assertFailure(mover.move(self.source, self.target),
+                                 VerificationFailed)
+        self.assertEqual(self.source.getContent(), self.data)
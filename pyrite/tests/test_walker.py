@@ -0,0 +1,114 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import os
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import TestCase
+
+from pyrite import walker
+from pyrite.walker import Found, Walker
+
+
+class TestWalker(TestCase):
+
+    def setUp(self):
+        self.root = FilePath(self.mktemp())
+        self.root.child("Show").makedirs()
+        self.root.child("Show").child("Sample").makedirs()
+
+        self.root.child("movie.mkv").setContent("x" * 100)
+        self.root.child("movie.nfo").setContent("x" * 10)
+        self.root.child("Show").child("episode.MP4").setContent("x" * 50)
+        self.root.child("Show").child("Sample").child("sample.mkv")\
+            .setContent("x" * 5)
+
+    def walk(self, **kwargs):
+        found = Walker(**kwargs).walk(self.root.path)
+        return sorted(os.path.relpath(f.path, self.root.path) for f in found)
+
+    def test_everything(self):
+        self.assertEqual(self.walk(), [
+            "Show/Sample/sample.mkv",
+            "Show/episode.MP4",
+            "movie.mkv",
+            "movie.nfo",
+        ])
+
+    def test_lazy(self):
+        found = Walker().walk(self.root.path)
+        self.assertEqual(len(list(found)), 4)
+        self.assertEqual(list(found), [])
+
+    def test_records(self):
+        [found] = Walker(extensions=["nfo"]).walk(self.root.path)
+        self.assertEqual(found.name, "movie.nfo")
+        self.assertEqual(found.size, 10)
+
+    def test_extensions(self):
+        self.assertEqual(self.walk(extensions=["mkv", ".mp4"]), [
+            "Show/Sample/sample.mkv",
+            "Show/episode.MP4",
+            "movie.mkv",
+        ])
+
+    def test_sizes(self):
+        self.assertEqual(self.walk(min_size=10, max_size=50),
+                         ["Show/episode.MP4", "movie.nfo"])
+
+    def test_include(self):
+        self.assertEqual(self.walk(include=["movie.*"]),
+                         ["movie.mkv", "movie.nfo"])
+
+    def test_exclude(self):
+        self.assertEqual(self.walk(exclude=["*.nfo", "Sample"]),
+                         ["Show/episode.MP4", "movie.mkv"])
+
+    def test_file(self):
+        path = self.root.child("movie.mkv").path
+        self.assertEqual(list(Walker().walk(path)),
+                         [Found(path, "movie.mkv", 100)])
+        self.assertEqual(list(Walker(min_size=1000).walk(path)), [])
+        self.assertEqual(list(Walker(exclude=["*.mkv"]).walk(path)), [])
+
+    def test_symlink_loop(self):
+        self.root.linkTo(self.root.child("Show").child("loop"))
+        self.assertEqual(len(self.walk()), 4)
+
+    def test_symlinked_file(self):
+        self.root.child("movie.mkv").linkTo(self.root.child("link.mkv"))
+        self.root.child("missing").linkTo(self.root.child("broken.mkv"))
+        self.assertIn("link.mkv", self.walk())
+        self.assertNotIn("broken.mkv", self.walk())
+
+    def test_listdir(self):
+        self.patch(walker, "scandir", None)
+        self.assertEqual(self.walk(exclude=["Sample"]), [
+            "Show/episode.MP4",
+            "movie.mkv",
+            "movie.nfo",
+        ])
+
+    def test_listdir_leaves(self):
+        self.patch(walker, "scandir", None)
+        notes = self.root.descendant(["Show", "Sample", "notes.txt"])
+        notes.setContent("notes")
+        stats = []
+        self.patch(walker.os, "lstat",
+                   lambda path: stats.append(path) or os.stat(path))
+        self.assertEqual(self.walk(extensions=["mkv"]),
+                         ["Show/Sample/sample.mkv", "movie.mkv"])
+        if os.stat(self.root.path).st_nlink >= 2:
+            # Nothing in Sample, which has no subdirectories, was looked at
+            # unless it was wanted.
+            self.assertNotIn(notes.path, stats)
@@ -0,0 +1,136 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from pyrite.walker import Walker
+from pyrite.watch import (IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, IN_MOVED_TO,
+                          Watcher)
+
+IN_MODIFY = 0x00000002
+
+
+class RecordingNamer(object):
+
+    def __init__(self, walker=None):
+        self.walker = walker or Walker()
+        self.processed = []
+        self.results = {}
+
+    def process(self, path, dest):
+        self.processed.append(path)
+        return self.results.get(path, succeed(None))
+
+
+class TestWatcher(SynchronousTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.namer = RecordingNamer()
+        self.root = root = FilePath(self.mktemp())
+        root.makedirs()
+        self.path = root.child("file.mkv")
+        self.path.setContent("contents")
+        self.watcher = Watcher(self.clock, self.namer, root,
+                               root.child("dest"), settle=5)
+
+    def test_settle(self):
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.clock.advance(4)
+        self.assertEqual(self.namer.processed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.namer.processed, [self.path])
+
+    def test_reset(self):
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.clock.advance(4)
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.clock.advance(4)
+        self.assertEqual(self.namer.processed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.namer.processed, [self.path])
+
+    def test_moved(self):
+        self.watcher.notify(None, self.path, IN_MOVED_TO)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [self.path])
+
+    def test_ignored(self):
+        self.watcher.notify(None, self.path, IN_MODIFY)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [])
+
+    def test_vanished(self):
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.path.remove()
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [])
+
+    def test_subdirectory(self):
+        subdir = self.root.child("Show")
+        subdir.makedirs()
+        episode = subdir.child("episode.mkv")
+        episode.setContent("contents")
+
+        self.watcher.notify(None, subdir, IN_MOVED_TO | IN_ISDIR)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [episode])
+
+    def test_subdirectory_made(self):
+        subdir = self.root.child("Show")
+        subdir.makedirs()
+        self.watcher.notify(None, subdir, IN_CREATE | IN_ISDIR)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [])
+
+    def test_unwanted(self):
+        self.namer.walker = Walker(exclude=["Sample", "*.nfo"])
+        sample = self.root.child("Sample")
+        sample.makedirs()
+        clip = sample.child("clip.mkv")
+        clip.setContent("contents")
+        nfo = self.root.child("file.nfo")
+        nfo.setContent("contents")
+
+        for path in clip, nfo, self.path:
+            self.watcher.notify(None, path, IN_CLOSE_WRITE)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [self.path])
+
+    def test_too_small(self):
+        self.namer.walker = Walker(min_size=1024)
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [])
+
+    def test_stop(self):
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.successResultOf(self.watcher.stop())
+        self.clock.advance(5)
+        self.assertEqual(self.namer.processed, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stop_waits(self):
+        self.namer.results[self.path] = d = Deferred()
+        self.watcher.notify(None, self.path, IN_CLOSE_WRITE)
+        self.clock.advance(5)
+
+        stopped = self.watcher.stop()
+        self.assertNoResult(stopped)
+        self.assertNoResult(self.watcher._done)
+        d.callback(None)
+        self.successResultOf(stopped)
+        self.successResultOf(self.watcher._done)
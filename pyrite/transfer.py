@@ -0,0 +1,378 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Putting files into place, even across filesystems.
+
+Files can be moved, or, to keep the originals, hardlinked, symlinked,
+reflinked, or copied. Anything which can't be done between two
+filesystems falls back to something which can, and ultimately to a copy,
+which is made in the kernel where possible. Everything is made under a
+temporary name next to its target, and only renamed into place once it's
+complete.
+"""
+
+import ctypes
+from ctypes.util import find_library
+import errno
+from fcntl import ioctl
+import io
+import os
+import shutil
+from tempfile import mkstemp
+
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+from pyrite.errors import VerificationFailed
+from pyrite.hashing import chunks, hash_file
+from pyrite.parallel import ThreadedHasher
+
+# How much to ask the kernel to copy at a time.
+COPY_CHUNK = 64 * 1024 * 1024
+
+# The ioctl which makes a file share another's data, from linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors which mean that something can't be done between these files, as
+# opposed to having gone wrong partway.
+unsupported = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EPERM, errno.EMLINK)
+
+
+def _libc_function(name, restype, *argtypes):
+    """
+    Find a function in the C library, or return None if it isn't there.
+    """
+
+    try:
+        libc = ctypes.CDLL(find_library("c"), use_errno=True)
+        f = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+
+    f.restype = restype
+    f.argtypes = argtypes
+    return f
+
+
+def _checked(f):
+    """
+    Turn a C function's -1 and errno into an OSError.
+    """
+
+    def wrapper(*args):
+        rv = f(*args)
+        if rv < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return rv
+    return wrapper
+
+
+_copy_file_range = _libc_function("copy_file_range", ctypes.c_ssize_t,
+                                  ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_size_t, ctypes.c_uint)
+_sendfile = _libc_function("sendfile", ctypes.c_ssize_t, ctypes.c_int,
+                           ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+
+
+def copy_file_range(src, dst, count):
+    """
+    Copy up to count bytes between file descriptors without them passing
+    through userspace. Some filesystems, like NFS, can even do this without
+    the data passing through this machine.
+    """
+
+    if hasattr(os, "copy_file_range"):
+        return os.copy_file_range(src, dst, count)
+    return _checked(_copy_file_range)(src, None, dst, None, count, 0)
+
+
+def sendfile(src, dst, count):
+    """
+    Copy up to count bytes between file descriptors without them passing
+    through userspace.
+    """
+
+    if hasattr(os, "sendfile"):
+        return os.sendfile(dst, src, None, count)
+    return _checked(_sendfile)(dst, src, None, count)
+
+
+methods = []
+if hasattr(os, "copy_file_range") or _copy_file_range is not None:
+    methods.append(copy_file_range)
+if hasattr(os, "sendfile") or _sendfile is not None:
+    methods.append(sendfile)
+
+
+def copy_fds(src, dst, size, chunk=COPY_CHUNK, methods=methods):
+    """
+    Copy size bytes from one file descriptor to another, starting at their
+    current offsets.
+
+    Each of the kernel copying methods is tried in turn, and if none of them
+    can copy between these two files, the data is copied by hand.
+
+    Returns the number of bytes copied, which is less than size only if the
+    source was shorter than expected.
+    """
+
+    copied = 0
+
+    for method in methods:
+        try:
+            while copied < size:
+                count = method(src, dst, min(chunk, size - copied))
+                if not count:
+                    break
+                copied += count
+            return copied
+        except OSError as e:
+            if copied or e.errno not in unsupported:
+                raise
+
+    reader = io.FileIO(src, "r", closefd=False)
+    writer = io.open(dst, "wb", closefd=False)
+    for piece in chunks(reader, min(chunk, max(size, 1))):
+        writer.write(piece)
+        copied += len(piece)
+    writer.flush()
+    return copied
+
+
+def _temporary(target):
+    """
+    Pick an unused name for a temporary file beside target.
+    """
+
+    return target.sibling(".%s.%s.part" % (target.basename(),
+                                           os.urandom(4).encode("hex")))
+
+
+def _sync_directory(path):
+    """
+    Make sure that a directory's entries are on disk.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _linked(make, source, target):
+    """
+    Make a link to source under a temporary name, then rename it to target.
+    """
+
+    temp = _temporary(target)
+    make(source.path, temp.path)
+    try:
+        os.rename(temp.path, target.path)
+    except:
+        os.unlink(temp.path)
+        raise
+
+
+def _written(write, source, target):
+    """
+    Call write with file descriptors for source and a temporary file, and
+    the temporary file's path, then rename the temporary file to target,
+    with source's permissions and times.
+    """
+
+    fd, temp = mkstemp(prefix=".%s." % target.basename(), suffix=".part",
+                       dir=target.dirname())
+    try:
+        try:
+            with source.open("rb") as handle:
+                write(handle.fileno(), fd, temp)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        shutil.copystat(source.path, temp)
+        os.rename(temp, target.path)
+    except:
+        os.unlink(temp)
+        raise
+
+
+def replace_with_link(original, duplicate):
+    """
+    Replace a file with a hardlink to an identical one, so that they share
+    their disk space.
+    """
+
+    _linked(os.link, original, duplicate)
+
+
+def rename(source, target, verify=False, expected=None):
+    os.rename(source.path, target.path)
+
+
+def hardlink(source, target, verify=False, expected=None):
+    _linked(os.link, source, target)
+
+
+def symlink(source, target, verify=False, expected=None):
+    _linked(os.symlink, source, target)
+
+
+def reflink(source, target, verify=False, expected=None):
+    """
+    Make target share source's data, on filesystems which can, like btrfs
+    and XFS. Nothing is copied until one of them is changed.
+    """
+
+    _written(lambda src, dst, temp: ioctl(dst, FICLONE, src), source, target)
+
+
+# Digests which cover every byte of a file, unlike the OSDB hash.
+WHOLE_FILE = "ed2k", "md5", "sha1"
+
+
+def copy(source, target, verify=False, expected=None):
+    """
+    Copy source to target.
+
+    If verify is set, the copy is hashed and compared with the source's
+    digests before it's renamed into place. Those can be passed in as
+    expected, if they were computed already; unless they include a digest
+    of the whole file, the source is hashed too.
+    """
+
+    def write(src, dst, temp):
+        size = os.fstat(src).st_size
+        if copy_fds(src, dst, size) != size:
+            raise VerificationFailed("%r shrank while being copied"
+                                     % source.path)
+
+        if verify:
+            digests = expected
+            if not any(kind in (expected or ()) for kind in WHOLE_FILE):
+                digests = hash_file(source)
+            actual = hash_file(FilePath(temp))
+            for kind in digests:
+                if kind in actual and actual[kind] != digests[kind]:
+                    raise VerificationFailed("Copy of %r has the wrong %s"
+                                             % (source.path, kind))
+
+    _written(write, source, target)
+
+
+# What to try for each kind of placement, in order. Each ends with a copy,
+# which works between any two filesystems.
+placements = {
+    "move": (rename, copy),
+    "hardlink": (hardlink, reflink, copy),
+    "reflink": (reflink, copy),
+    "symlink": (symlink, copy),
+    "copy": (copy,),
+}
+
+
+def place_file(source, target, placement="move", verify=False,
+               expected=None):
+    """
+    Put a file at target, trying each of the ways to do so for a placement
+    in turn until one works.
+
+    A "move" which can't be done with a rename is done as a copy, after
+    which the source is removed.
+
+    Returns the function which worked.
+    """
+
+    for strategy in placements[placement]:
+        try:
+            strategy(source, target, verify, expected)
+        except (IOError, OSError) as e:
+            if strategy is copy or e.errno not in unsupported:
+                raise
+        else:
+            break
+
+    if placement == "move" and strategy is not rename:
+        # Until the new entry is on disk, a crash could lose both copies.
+        _sync_directory(target.dirname())
+        os.unlink(source.path)
+
+    return strategy
+
+
+def move_file(source, target, verify=False, expected=None):
+    """
+    Move a file, copying it if the target is on another filesystem.
+
+    Returns True if the file had to be copied.
+    """
+
+    return place_file(source, target, "move", verify, expected) is copy
+
+
+class Mover(object):
+    """
+    Moves files in threads, so that several slow copies between filesystems
+    can be in progress at once without blocking the reactor.
+
+    The placement decides whether originals are moved, or kept and linked or
+    copied; see placements. With verify set, copies are checked against the
+    digests already in the hash cache before they're put in place; if none of
+    those cover the whole file, the source is hashed again.
+    """
+
+    def __init__(self, reactor, transfers=2, cache=None, verify=False,
+                 placement="move"):
+        self._reactor = reactor
+        self._threads = ThreadedHasher(reactor, transfers)
+        self._cache = cache
+        self._verify = verify
+        self.placement = placement
+
+    def move(self, source, target):
+        """
+        Place a file, returning a Deferred which fires when it has arrived.
+        """
+
+        expected = None
+        if self._verify and self._cache is not None:
+            # The cache can only be used from the reactor thread.
+            expected = self._cache.get(source)
+
+        log.msg("Placing %r at %r (%s)"
+                % (source.path, target.path, self.placement))
+
+        size = source.getsize()
+        start = self._reactor.seconds()
+
+        d = self._threads.run(place_file, source, target, self.placement,
+                              self._verify, expected)
+
+        @d.addCallback
+        def cb(strategy):
+            wanted = placements[self.placement][0]
+            if strategy is not wanted and self.placement != "move":
+                log.msg("Couldn't %s %r; used %s instead"
+                        % (wanted.__name__, source.path, strategy.__name__))
+            if strategy is copy:
+                elapsed = max(self._reactor.seconds() - start, 0.001)
+                log.msg("Copied %r at %.1f MiB/s"
+                        % (target.path, size / elapsed / 1024 / 1024))
+
+        return d
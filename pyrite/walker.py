@@ -0,0 +1,224 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Walking directory trees quickly, without looking twice at anything.
+"""
+
+from collections import namedtuple
+from fnmatch import fnmatch
+import os
+import stat
+
+from twisted.python import log
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+Found = namedtuple("Found", "path name size")
+
+
+class _Entry(object):
+    """
+    Enough of a DirEntry for walking, made with os.listdir() and os.lstat(),
+    for when scandir isn't available.
+    """
+
+    _lstat = None
+    _stat = None
+
+    def __init__(self, top, name):
+        self.name = name
+        self.path = os.path.join(top, name)
+
+    def is_symlink(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def stat(self):
+        if self._stat is None:
+            if self.is_symlink():
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._lstat
+        return self._stat
+
+    def _mode(self):
+        try:
+            return self.stat().st_mode
+        except OSError:
+            # Broken symlinks are neither files nor directories.
+            return 0
+
+    def is_dir(self):
+        return stat.S_ISDIR(self._mode())
+
+    def is_file(self):
+        return stat.S_ISREG(self._mode())
+
+
+def _listdir(top, st, wanted):
+    """
+    List a directory without scandir.
+
+    Telling files from directories takes an lstat() each. Where the
+    filesystem keeps count, a directory's link count says how many
+    subdirectories it has; once they've all been found, the rest of its
+    entries are only looked at if wanted(name) says their names are wanted.
+    Symlinks to directories among those are not followed.
+    """
+
+    # Each subdirectory links back with its "..", on top of the directory's
+    # own two links. Filesystems which don't count, like btrfs, say 1.
+    subdirs = st.st_nlink - 2 if st.st_nlink >= 2 else None
+
+    for name in os.listdir(top):
+        if subdirs == 0 and not wanted(name):
+            continue
+
+        entry = _Entry(top, name)
+        if subdirs:
+            try:
+                if entry.is_dir() and not entry.is_symlink():
+                    subdirs -= 1
+            except OSError:
+                continue
+        yield entry
+
+
+class Walker(object):
+    """
+    Finds the files under a directory which are worth naming.
+
+    Files can be picked by extension, by size, and by glob patterns on their
+    names; directories whose names match an exclusion are skipped entirely.
+    Symlinks are followed, but never into a directory which was already
+    walked.
+    """
+
+    def __init__(self, extensions=None, min_size=0, max_size=None,
+                 include=(), exclude=()):
+        if extensions is not None:
+            extensions = set("." + ext.lower().lstrip(".")
+                             for ext in extensions)
+        self._extensions = extensions
+        self._min_size = min_size
+        self._max_size = max_size
+        self._include = include
+        self._exclude = exclude
+
+    def excluded(self, name):
+        return any(fnmatch(name, pattern) for pattern in self._exclude)
+
+    def wanted(self, name):
+        """
+        Whether a file is wanted, going only by its name.
+        """
+
+        if self.excluded(name):
+            return False
+
+        if self._extensions is not None:
+            ext = os.path.splitext(name)[1].lower()
+            if ext not in self._extensions:
+                return False
+
+        if self._include:
+            return any(fnmatch(name, pattern) for pattern in self._include)
+
+        return True
+
+    def sized(self, size):
+        """
+        Whether a file is wanted, going by its size.
+        """
+
+        if size < self._min_size:
+            return False
+        return self._max_size is None or size <= self._max_size
+
+    def finds(self, top, path):
+        """
+        Whether walking top would find the file at path, which is under it.
+        """
+
+        segments = os.path.relpath(path, top).split(os.sep)
+        if any(self.excluded(segment) for segment in segments[:-1]):
+            return False
+        if not self.wanted(segments[-1]):
+            return False
+        return self.sized(os.stat(path).st_size)
+
+    def _scan(self, path, st):
+        if scandir is None:
+            return _listdir(path, st, self.wanted)
+        return scandir(path)
+
+    def walk(self, top):
+        """
+        Lazily yield a Found for each wanted file under the path top, or
+        for top itself, if it's a wanted file.
+
+        Names are checked before anything is stat()'d, and nothing is
+        stat()'d twice; with scandir, only wanted files and directories are
+        stat()'d at all. Directories which can't be read are logged and
+        skipped.
+        """
+
+        st = os.stat(top)
+        if stat.S_ISREG(st.st_mode):
+            name = os.path.basename(top)
+            if self.wanted(name) and self.sized(st.st_size):
+                yield Found(top, name, st.st_size)
+            return
+
+        seen = set([(st.st_dev, st.st_ino)])
+        stack = [iter(self._scan(top, st))]
+
+        while stack:
+            try:
+                entry = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                continue
+            except OSError as e:
+                log.msg("Couldn't read directory: %s" % e)
+                stack.pop()
+                continue
+
+            if self.excluded(entry.name):
+                continue
+
+            try:
+                if entry.is_dir():
+                    st = entry.stat()
+                    key = st.st_dev, st.st_ino
+                    if key in seen:
+                        log.msg("Not walking %r again" % entry.path)
+                        continue
+                    seen.add(key)
+                    stack.append(iter(self._scan(entry.path, st)))
+                elif self.wanted(entry.name) and entry.is_file():
+                    size = entry.stat().st_size
+                    if self.sized(size):
+                        yield Found(entry.path, entry.name, size)
+            except OSError as e:
+                log.msg("Couldn't look at %r: %s" % (entry.path, e))
@@ -0,0 +1,159 @@
+# Copyright (C) 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Watching a directory for new files, and naming them as they arrive.
+
+This needs Linux, for inotify.
+"""
+
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+# Mirrors of the masks in twisted.internet.inotify, so that this module can
+# be imported, and tested, without it.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+
+MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+class Watcher(object):
+    """
+    Feeds files into a Namer as they finish arriving in a directory.
+
+    A file is considered finished once it has been closed after writing (or
+    moved into place) and then left alone for settle seconds, so that
+    downloaders which reopen files don't get them renamed out from under
+    them.
+
+    Directories which are made or moved into the watched directory are
+    watched too, and any files already in them are named.
+    """
+
+    _notifier = None
+
+    def __init__(self, reactor, namer, source, dest, settle=5,
+                 concurrency=1):
+        self._reactor = reactor
+        self._namer = namer
+        self._source = source
+        self._dest = dest
+        self._settle = settle
+        self._sem = DeferredSemaphore(concurrency)
+
+        self._timers = {}
+        self._pending = set()
+        self._done = Deferred()
+
+    def start(self):
+        """
+        Start watching.
+
+        Returns a Deferred which fires after stop() is called.
+        """
+
+        from twisted.internet import inotify
+
+        self._notifier = inotify.INotify(reactor=self._reactor)
+        self._notifier.startReading()
+        self._watch(self._source)
+
+        log.msg("Watching %r" % self._source.path)
+        return self._done
+
+    def _watch(self, path):
+        self._notifier.watch(path, mask=MASK, autoAdd=True, recursive=True,
+                             callbacks=[self.notify])
+
+    def stop(self):
+        """
+        Stop watching, dropping any files which haven't settled yet.
+
+        Returns a Deferred which fires once the files which had settled are
+        done with.
+        """
+
+        log.msg("No longer watching %r" % self._source.path)
+
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+        d = DeferredList(list(self._pending))
+
+        @d.addCallback
+        def done(chaff):
+            if not self._done.called:
+                self._done.callback(None)
+
+        return d
+
+    def notify(self, ignored, filepath, mask):
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._arrived(filepath)
+            return
+
+        if not mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            return
+
+        timer = self._timers.get(filepath)
+        if timer is not None:
+            timer.reset(self._settle)
+        else:
+            self._timers[filepath] = self._reactor.callLater(
+                self._settle, self._settled, filepath)
+
+    def _arrived(self, dirpath):
+        """
+        Start watching a new directory, and look at what's already in it.
+
+        inotify only adds made directories by itself, and not those moved
+        in; either way, files may have arrived before the watch was added.
+        """
+
+        if self._notifier is not None:
+            self._watch(dirpath)
+
+        for found in self._namer.walker.walk(dirpath.path):
+            self.notify(None, FilePath(found.path), IN_CLOSE_WRITE)
+
+    def _settled(self, filepath):
+        del self._timers[filepath]
+
+        if not filepath.isfile():
+            return
+
+        if not self._namer.walker.finds(self._source.path, filepath.path):
+            log.msg("Not naming unwanted %r" % filepath.path)
+            return
+
+        log.msg("%r has settled" % filepath.path)
+        d = self._sem.run(self._namer.process, filepath, self._dest)
+        d.addErrback(log.err, "Couldn't process %r" % filepath.path)
+
+        self._pending.add(d)
+
+        @d.addBoth
+        def finished(result):
+            self._pending.discard(d)
+            return result